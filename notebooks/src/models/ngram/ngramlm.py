@@ -1,52 +1,88 @@
+import os
+import re
+import copy
+import json
+import multiprocessing
 import numpy as np
 import pandas as pd
-import spacy
+import scipy.sparse
 
 from tqdm import tqdm
-from collections import Counter, defaultdict
-from itertools import product
+from collections import Counter, OrderedDict, defaultdict
+from itertools import chain, islice
+
+
+# Numbers (incl. decimals), words, clitics like 's or 't, and individual punctuation marks
+TOKEN_PATTERN = re.compile(r"\d+(?:[.,]\d+)*|\w+|'\w+|[^\w\s]")
+
+def regex_tokenize(sentence):
+    return TOKEN_PATTERN.findall(sentence)
+
+def whitespace_tokenize(sentence):
+    return sentence.split()
+
+_nlp = None
+
+def spacy_tokenize(sentence):
+    global _nlp
+    # spaCy is only imported (and the blank pipeline created) when this tokenizer is actually used
+    if _nlp is None:
+        import spacy
+        _nlp = spacy.blank("en")
+    return [ t.text for t in _nlp.make_doc(sentence) ]
+
+TOKENIZERS = { "regex": regex_tokenize, "whitespace": whitespace_tokenize, "spacy": spacy_tokenize }
 
-nlp = spacy.blank("en")
-nlp.add_pipe("sentencizer")
 
 
 class NGramLanguageModel:
-    def __init__(self, N=2, k=1.0, lowercase=False):
+    def __init__(self, N=2, k=1.0, lowercase=False, tokenizer="regex", cache_size=100_000):
         self.lowercase = lowercase
         if N < 2:
             raise ValueError("N must be > 1")
         self.N = N
         self.k = k
-        self.ngram_counts = Counter()
-        self.context_counts = Counter()
-        self.vocab = set()
+        # Tokenizer is either the name of a built-in tokenizer or any function that maps a string to a list of tokens
+        # (module-level functions also work with multiple worker processes)
+        if isinstance(tokenizer, str):
+            if tokenizer not in TOKENIZERS:
+                raise ValueError(f"Unknown tokenizer: {tokenizer}")
+            tokenizer = TOKENIZERS[tokenizer]
+        self.tokenizer = tokenizer
+        # Maximum number of contexts for which the next-word distribution is cached
+        self.cache_size = cache_size
         self.SOS = "[SOS]"
         self.EOS = "[EOS]"
-        # Dictionary that keeps list of candidate words given context
-        # When generating a text, we only pick from those candidate words
-        self.contexts = {}
-        self.token_count = 0
+        self.reset()
 
     def reset(self):
         self.ngram_counts = Counter()
         self.context_counts = Counter()
         self.vocab = set()
+        # Dictionary that keeps list of candidate words given context
+        # When generating a text, we only pick from those candidate words
         self.contexts = {}
-        self.token_count = 0        
+        self.token_count = 0
+        self.distribution_cache = OrderedDict()
     
     def _preprocess_sentence(self, sentence):
-        doc = nlp.make_doc(sentence)
-        # Tokenize sentence using spaCy
-        if self.lowercase is True:
-            tokens = [ t.text.lower() for t in doc ]
+        # Tokenize sentence (unless the sentence is already given as a list of tokens)
+        if isinstance(sentence, str):
+            tokens = self.tokenizer(sentence)
         else:
-            tokens = [ t.text for t in doc ]
+            tokens = list(sentence)
+        if self.lowercase is True:
+            tokens = [ t.lower() for t in tokens ]
         # Add special tokens and return final list
         return [self.SOS]*(self.N-1) + tokens + [self.EOS]
     
     def train(self, sentences: list[str]):
-        self.reset();
-        # Iterate through all sentences in dataset
+        self.reset()
+        self.update(sentences)
+
+    def update(self, sentences):
+        # Iterate through all sentences in dataset; this can be any iterable (e.g., a generator or
+        # map(str.strip, file)) and all counts are added to the existing ones (i.e., no reset)
         for sentence in tqdm(sentences):
             # Tokenize sentence and add special tokens
             tokens = self._preprocess_sentence(sentence)
@@ -67,6 +103,14 @@ class NGramLanguageModel:
                     self.contexts[context].add(word)
                 else:
                     self.contexts[context] = set([word])
+        # Cached distributions are no longer valid after the update
+        self.distribution_cache.clear()
+
+    def get_ngram_count(self, ngram):
+        return self.ngram_counts[tuple(ngram)]
+
+    def get_context_count(self, context):
+        return self.context_counts[tuple(context)]
 
     def compute_ngram_probability(self, word, context):
         # Shorten context if needed
@@ -81,6 +125,9 @@ class NGramLanguageModel:
     def compute_sentence_log_probability(self, sentence):
         # Tokenize sentence and add special tokens
         tokens = self._preprocess_sentence(sentence)
+        return self._compute_tokens_log_probability(tokens)
+
+    def _compute_tokens_log_probability(self, tokens):
         # Intialize log probability to 0
         log_prob = 0.0
         # Iterate through all tokens to generate ngrams and contexts
@@ -98,12 +145,36 @@ class NGramLanguageModel:
         total_tokens = 0
 
         for sentence in sentences:
+            # Tokenize each sentence only once
             tokens = self._preprocess_sentence(sentence)
-            total_log_prob += self.compute_sentence_log_probability(sentence)
+            total_log_prob += self._compute_tokens_log_probability(tokens)
             total_tokens += len(tokens)
 
         return np.exp(-total_log_prob / total_tokens)
 
+    def _get_next_word_distribution(self, context):
+        # Get all candidate words for the context together with their probabilities
+        words = np.asarray(list(self.contexts[tuple(context)]))
+        probs = np.asarray([self.compute_ngram_probability(w, context) for w in words])
+        return words, probs
+
+    def _get_sampling_distribution(self, context):
+        context = tuple(context)
+        # If cached, mark the context as most recently used and return its distribution
+        if context in self.distribution_cache:
+            self.distribution_cache.move_to_end(context)
+            return self.distribution_cache[context]
+        # Sort candidate words by probability (descending) so the topk words are always the first k words
+        words, probs = self._get_next_word_distribution(context)
+        order = np.argsort(-probs, kind="stable")
+        # Precompute the cumulative probabilities so sampling becomes a single binary search
+        distribution = (words[order], np.cumsum(probs[order]))
+        self.distribution_cache[context] = distribution
+        # Drop the least recently used context if the cache is full
+        if len(self.distribution_cache) > self.cache_size:
+            self.distribution_cache.popitem(last=False)
+        return distribution
+
     def generate(self, max_tokens: int = 30, start_context: list[str] = [], topk: int = 20):
         # The following block merely prepares the first context; note that the context is always of size
         # (self.n - 1) so depending on the start_context (representing the start/seed words), we need to
@@ -118,22 +189,14 @@ class NGramLanguageModel:
 
         # Generate the next word in each iteration
         for _ in range(max_tokens):
-            # Compute the probabilities for all word
-            words = np.asarray(list(self.contexts[tuple(context)]))
-            probs = np.asarray([self.compute_ngram_probability(w, context) for w in words])
+            # Get all candidate words (sorted by probability) and their cumulative probabilities
+            words, cum_probs = self._get_sampling_distribution(context)
             # If specified, limit choice of word to topk words with the highest probabilities
-            if topk is not None:
-                # Make sure that we have words to select from
-                topk = min(topk, len(words))
-                # Get indices of the k largest elements (unsorted)
-                top_probs_indices = np.argpartition(probs, -topk)[-topk:]
-                # Extrat the relevant words and probabilities
-                words = words[top_probs_indices]
-                probs = probs[top_probs_indices]
-                # Normalize probabilities to they sum up to 1
-                probs = probs / probs.sum()
-            # Randomly select next word (proportional to probabilities)
-            word = np.random.choice(words, size=1, p=probs)[0]
+            num_words = len(words) if topk is None else min(topk, len(words))
+            # Randomly select next word (proportional to probabilities); scaling by the total of the
+            # first num_words probabilities normalizes the probabilities so they sum up to 1
+            idx = np.searchsorted(cum_probs[:num_words], np.random.random() * cum_probs[num_words-1], side="right")
+            word = words[min(idx, num_words-1)]
             # If the next word is the EOS token, stop generating tokens
             if word == self.EOS:
                 break
@@ -147,33 +210,752 @@ class NGramLanguageModel:
 
 
 
+def _extract_ngrams(sequences, N):
+    # Concatenate all sequences of token ids and remember which sequence each position belongs to
+    lengths = np.asarray([ len(s) for s in sequences ], dtype=np.int64)
+    ids = np.fromiter(chain.from_iterable(sequences), dtype=np.int32, count=int(lengths.sum()))
+    if len(ids) < N:
+        return np.empty((0, N), dtype=np.int32)
+    sequence_indices = np.repeat(np.arange(len(lengths)), lengths)
+    # Get all windows of size N; only windows that do not cross the boundary of a sequence are valid n-grams
+    windows = np.lib.stride_tricks.sliding_window_view(ids, N)
+    return windows[sequence_indices[:-(N-1)] == sequence_indices[N-1:]]
+
+
+def _unique_ngrams(ngrams, counts):
+    if len(ngrams) == 0:
+        return ngrams.astype(np.int32), counts.astype(np.int64)
+    # Sort n-grams lexicographically (np.lexsort uses the last key as the primary key)
+    order = np.lexsort(ngrams.T[::-1])
+    ngrams, counts = ngrams[order], counts[order]
+    # Mark the first occurrence of each distinct n-gram and sum up the counts for each n-gram
+    is_new = np.ones(len(ngrams), dtype=bool)
+    is_new[1:] = np.any(ngrams[1:] != ngrams[:-1], axis=1)
+    starts = np.flatnonzero(is_new)
+    return ngrams[starts].astype(np.int32), np.add.reduceat(counts, starts).astype(np.int64)
+
+
+def _batched(iterable, size):
+    # Split an iterable into lists of the given size (the last list might be shorter)
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _count_shard(args):
+    # Count all n-grams of a shard of sentences in a separate store (executed by a worker process)
+    model, sentences = args
+    store = NGramCountStore(model.N)
+    token_count = model._count_sentences(sentences, store)
+    store.merge()
+    return store.id2token, store.pending_ngrams, store.pending_counts, token_count, len(sentences)
+
+
+def _gather(values, indices):
+    # Look up values for all indices; an index of -1 (i.e., not found) yields 0
+    result = np.zeros(len(indices), dtype=values.dtype)
+    found = indices >= 0
+    result[found] = values[indices[found]]
+    return result
+
+
+
+class NGramCountStore:
+    """
+    Implements a compact, array-backed store for n-gram counts. All tokens are mapped to integer ids, and
+    the n-grams of each order k=1..N are kept as sorted int64 keys, where the key of a k-gram combines the
+    index of its (k-1)-gram prefix with the id of its last token (i.e., a trie flattened into arrays).
+    """
+
+    def __init__(self, N):
+        self.N = N
+        # Mappings between tokens and their integer ids
+        self.token2id = {}
+        self.id2token = []
+        # N-grams (as rows of token ids) and their counts not yet added to the index
+        self.pending_ngrams = np.empty((0, N), dtype=np.int32)
+        self.pending_counts = np.empty(0, dtype=np.int64)
+        # Batches of n-grams and counts not yet merged into the pending n-grams
+        self.buffered, self.buffered_size = [], 0
+        # Number of bits used for a token id within a key
+        self.wbits = 1
+        # Sorted keys for each order (self.keys[0] are unigrams, self.keys[N-1] are full n-grams)
+        self.keys = [ np.empty(0, dtype=np.int64) for _ in range(N) ]
+        # Counts of all n-grams (aligned with self.keys[N-1])
+        self.ngram_counts = np.empty(0, dtype=np.int64)
+        # Counts of all contexts (aligned with self.keys[N-2]), and the range of n-grams for each context
+        self.context_counts = np.empty(0, dtype=np.int64)
+        self.context_offsets = np.zeros(1, dtype=np.int64)
+        # Total count of pruned n-grams for each context (None if nothing has been pruned)
+        self.context_pruned_counts = None
+
+    def intern(self, tokens):
+        # Map all tokens to their ids; unseen tokens get added to the vocabulary
+        ids = []
+        for t in tokens:
+            if t not in self.token2id:
+                self.token2id[t] = len(self.id2token)
+                self.id2token.append(t)
+            ids.append(self.token2id[t])
+        return ids
+
+    def encode(self, tokens):
+        # Map all tokens to their ids; unknown tokens are mapped to -1
+        return np.asarray([ self.token2id.get(t, -1) for t in tokens ], dtype=np.int64)
+
+    def decode(self, ids):
+        return [ self.id2token[i] for i in ids ]
+
+    def add_sequences(self, sequences):
+        # Extract all n-grams from the sequences of token ids and add them to the pending n-grams
+        ngrams = _extract_ngrams(sequences, self.N)
+        self.add_ngrams(ngrams, np.ones(len(ngrams), dtype=np.int64))
+
+    def add_ngrams(self, ngrams, counts):
+        self.buffered.append((ngrams, counts))
+        self.buffered_size += len(ngrams)
+        # Only merge once the buffer has grown as large as the pending n-grams (amortizes the sorting)
+        if self.buffered_size >= len(self.pending_ngrams):
+            self.merge()
+
+    def merge(self):
+        # Merge all buffered batches into the pending n-grams
+        ngrams = np.concatenate([self.pending_ngrams] + [ b[0] for b in self.buffered ])
+        counts = np.concatenate([self.pending_counts] + [ b[1] for b in self.buffered ])
+        self.pending_ngrams, self.pending_counts = _unique_ngrams(ngrams, counts)
+        self.buffered, self.buffered_size = [], 0
+
+    def decode_ngrams(self):
+        # Reconstruct all indexed n-grams as rows of token ids by walking up the prefixes
+        mask = (1 << self.wbits) - 1
+        indices = np.arange(len(self.keys[-1]))
+        ngrams = np.empty((len(indices), self.N), dtype=np.int32)
+        for n in range(self.N-1, -1, -1):
+            keys = self.keys[n][indices]
+            ngrams[:, n] = keys & mask
+            indices = keys >> self.wbits
+        return ngrams
+
+    def build(self):
+        # Merge all already indexed n-grams with all pending n-grams
+        self.merge()
+        ngrams, counts = _unique_ngrams(np.concatenate([self.decode_ngrams(), self.pending_ngrams]),
+                                        np.concatenate([self.ngram_counts, self.pending_counts]))
+        self.pending_ngrams = np.empty((0, self.N), dtype=np.int32)
+        self.pending_counts = np.empty(0, dtype=np.int64)
+        # Compute the number of bits needed to represent each token id
+        self.wbits = max(1, len(self.id2token).bit_length())
+        return self._index(ngrams, counts)
+
+    def _index(self, ngrams, counts):
+        # Since n-grams are sorted lexicographically, each prefix forms a contiguous block of rows
+        parents = np.zeros(len(ngrams), dtype=np.int64)
+        for n in range(self.N):
+            if len(ngrams) > 0 and parents[-1] >= (1 << (63 - self.wbits)):
+                raise ValueError("Too many n-grams to fit into int64 keys")
+            keys = (parents << self.wbits) | ngrams[:, n]
+            is_new = np.ones(len(keys), dtype=bool)
+            is_new[1:] = keys[1:] != keys[:-1]
+            self.keys[n] = keys[is_new]
+            if n < self.N - 1:
+                starts = np.flatnonzero(is_new)
+                parents = np.cumsum(is_new) - 1
+        # The blocks of the last prefix level are the contexts
+        self.ngram_counts = counts
+        self.context_offsets = np.append(starts, len(ngrams)).astype(np.int64)
+        self.context_counts = np.add.reduceat(counts, starts) if len(starts) > 0 else np.empty(0, dtype=np.int64)
+        self.context_pruned_counts = None
+        return self
+
+    def prune(self, keep):
+        # Get the context of each n-gram (the n-grams of each context form a contiguous block)
+        contexts = np.repeat(np.arange(len(self.context_counts)), np.diff(self.context_offsets))
+        # Context counts stay unchanged, but keep track of the total count of the pruned n-grams for each context
+        pruned_counts = np.bincount(contexts[~keep], weights=self.ngram_counts[~keep], minlength=len(self.context_counts))
+        if self.context_pruned_counts is not None:
+            pruned_counts += self.context_pruned_counts
+        context_counts = self.context_counts
+        # Re-index the remaining n-grams; this also removes all contexts (and prefixes) without any n-grams left,
+        # which then count as unseen contexts
+        self._index(self.decode_ngrams()[keep], self.ngram_counts[keep])
+        remaining_contexts = np.unique(contexts[keep])
+        self.context_counts = np.asarray(context_counts[remaining_contexts], dtype=np.int64)
+        self.context_pruned_counts = pruned_counts[remaining_contexts].astype(np.int64)
+        return self
+
+    def estimate_nbytes(self, keep, count_bytes=8):
+        # Compute the number of keys for each order that would remain after prune(keep)
+        indices = np.flatnonzero(keep)
+        num_keys = [len(indices)]
+        for n in range(self.N-1, 0, -1):
+            indices = np.unique(self.keys[n][indices] >> self.wbits)
+            num_keys.append(len(indices))
+        # Memory for all keys, the n-gram counts, and the counts, pruned counts and offsets of all contexts
+        return 8 * sum(num_keys) + count_bytes * num_keys[0] + 8 * (3 * num_keys[1] + 1)
+
+    def lookup(self, ids):
+        # Find the position of each k-gram (rows of token ids) within self.keys[k-1]; -1 if not found
+        ids = np.atleast_2d(np.asarray(ids, dtype=np.int64))
+        found = np.all((ids >= 0) & (ids < (1 << self.wbits)), axis=1)
+        indices = np.zeros(len(ids), dtype=np.int64)
+        for n in range(ids.shape[1]):
+            keys = self.keys[n]
+            if len(keys) == 0:
+                return np.full(len(ids), -1, dtype=np.int64)
+            query = (indices << self.wbits) | np.where(found, ids[:, n], 0)
+            positions = np.minimum(np.searchsorted(keys, query), len(keys)-1)
+            found &= keys[positions] == query
+            indices = np.where(found, positions, 0)
+        return np.where(found, indices, -1)
+
+    def get_ngram_counts(self, ngram_ids):
+        ngram_ids = np.atleast_2d(ngram_ids)
+        # Only n-grams of size N have counts (same as a missing key in a Counter)
+        if ngram_ids.shape[1] != self.N:
+            return np.zeros(len(ngram_ids), dtype=np.int64)
+        if self.ngram_counts is None:
+            raise ValueError("The n-gram counts are no longer available (quantized model)")
+        return _gather(self.ngram_counts, self.lookup(ngram_ids))
+
+    def get_context_counts(self, context_ids):
+        context_ids = np.atleast_2d(context_ids)
+        # Only contexts of size N-1 have counts (same as a missing key in a Counter)
+        if context_ids.shape[1] != self.N - 1:
+            return np.zeros(len(context_ids), dtype=np.int64)
+        return _gather(self.context_counts, self.lookup(context_ids))
+
+    def get_context_stats(self, context_ids):
+        context_ids = np.atleast_2d(context_ids)
+        counts, followers, pruned_counts = [ np.zeros(len(context_ids), dtype=np.int64) for _ in range(3) ]
+        if context_ids.shape[1] != self.N - 1:
+            return counts, followers, pruned_counts
+        # Get the count of each context, the number of distinct (not pruned) words observed after each context,
+        # and the total count of all pruned n-grams of each context
+        indices = self.lookup(context_ids)
+        found = indices >= 0
+        counts[found] = self.context_counts[indices[found]]
+        followers[found] = self.context_offsets[indices[found]+1] - self.context_offsets[indices[found]]
+        if self.context_pruned_counts is not None:
+            pruned_counts[found] = self.context_pruned_counts[indices[found]]
+        return counts, followers, pruned_counts
+
+    def get_candidates(self, context_ids):
+        # Get the ids and counts of all words observed after the context
+        idx = self.lookup(context_ids)[0] if len(context_ids) == self.N - 1 else -1
+        if idx < 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        start, end = self.context_offsets[idx], self.context_offsets[idx+1]
+        counts = self.ngram_counts[start:end] if self.ngram_counts is not None else None
+        return self.keys[-1][start:end] & ((1 << self.wbits) - 1), counts
+
+    def save(self, path, name="store"):
+        # Make sure that all n-grams are indexed
+        if len(self.pending_ngrams) > 0 or len(self.buffered) > 0:
+            self.build()
+        # Save all index arrays as flat .npy files so they can be memory-mapped when loading
+        arrays = { f"keys{n+1}": keys for n, keys in enumerate(self.keys) }
+        arrays.update(ngram_counts=self.ngram_counts, context_counts=self.context_counts, context_offsets=self.context_offsets,
+                      context_pruned_counts=self.context_pruned_counts)
+        for array_name, array in arrays.items():
+            # Optional arrays (e.g., counts of pruned n-grams) are only saved if available
+            if array is None:
+                continue
+            np.save(os.path.join(path, f"{name}.{array_name}.npy"), array)
+        # Optional arrays of an earlier save into the same directory are not removed, so the flags decide what gets loaded
+        with open(os.path.join(path, f"{name}.json"), "w") as f:
+            json.dump({"N": self.N, "wbits": self.wbits, "quantized": self.ngram_counts is None,
+                       "pruned": self.context_pruned_counts is not None}, f)
+
+    @classmethod
+    def load(cls, path, name="store", mmap_mode="r"):
+        with open(os.path.join(path, f"{name}.json")) as f:
+            meta = json.load(f)
+        store = cls(meta["N"])
+        store.wbits = meta["wbits"]
+        # With mmap_mode="r", the arrays are not read into memory but mapped (and shared between processes)
+        def load_array(array_name):
+            return np.load(os.path.join(path, f"{name}.{array_name}.npy"), mmap_mode=mmap_mode)
+        store.keys = [ load_array(f"keys{n+1}") for n in range(store.N) ]
+        # The n-gram counts are dropped by quantizing, and the counts of pruned n-grams only exist after pruning
+        store.ngram_counts = load_array("ngram_counts") if not meta["quantized"] else None
+        store.context_counts = load_array("context_counts")
+        store.context_offsets = load_array("context_offsets")
+        store.context_pruned_counts = load_array("context_pruned_counts") if meta["pruned"] else None
+        return store
+
+    def nbytes(self):
+        # Memory used by all count and index arrays (excluding the vocabulary)
+        arrays = self.keys + [self.ngram_counts, self.context_counts, self.context_offsets, self.context_pruned_counts,
+                              self.pending_ngrams, self.pending_counts] + [ a for b in self.buffered for a in b ]
+        return sum(a.nbytes for a in arrays if a is not None)
+
 
 
-def generate_bigram_data(model, tokens, mode='counts', decimals=4):
+class CompactNGramLanguageModel(NGramLanguageModel):
+    """
+    Implements the same n-gram language model as NGramLanguageModel, but keeps all counts in a
+    NGramCountStore instead of dictionaries keyed by tuples of strings.
+    """
+
+    FORMAT_VERSION = 2
+
+    SMOOTHING__ADD_K          = "add-k"
+    SMOOTHING__KNESER_NEY     = "kneser-ney"
+    SMOOTHING__STUPID_BACKOFF = "stupid-backoff"
+
+    def __init__(self, N=2, k=1.0, lowercase=False, tokenizer="regex", smoothing=SMOOTHING__ADD_K, discount=None, alpha=0.4,
+                 cache_size=100_000, chunk_size=1_000_000):
+        if smoothing not in (self.SMOOTHING__ADD_K, self.SMOOTHING__KNESER_NEY, self.SMOOTHING__STUPID_BACKOFF):
+            raise ValueError(f"Unknown smoothing method: {smoothing}")
+        self.smoothing = smoothing
+        # Fixed discount for Kneser-Ney smoothing (if None, a discount is estimated for each order)
+        self.discount = discount
+        # Weight for each backoff step of Stupid Backoff
+        self.alpha = alpha
+        # Number of tokens to collect before the extracted n-grams get counted
+        self.chunk_size = chunk_size
+        super().__init__(N=N, k=k, lowercase=lowercase, tokenizer=tokenizer, cache_size=cache_size)
+
+    def reset(self):
+        self.store = NGramCountStore(self.N)
+        # The vocabulary is the mapping of tokens to ids (supports len() and "in" like a set)
+        self.vocab = self.store.token2id
+        self.token_count = 0
+        self.distribution_cache = OrderedDict()
+        # Tables for the lower orders (only needed for Kneser-Ney smoothing and Stupid Backoff)
+        self.order_stores = [None] * self.N + [self.store]
+        self.unigram_counts = np.empty(0, dtype=np.int64)
+        self.discounts = [0.0] * (self.N + 1)
+        # Quantized log probabilities of all n-grams of order N (None if the model is not quantized)
+        self.ngram_codes = None
+        self.codebook = None
+
+    def _count_sentences(self, sentences, store):
+        token_count, sequences, buffer_size = 0, [], 0
+        # Iterate through all sentences in dataset
+        for sentence in sentences:
+            # Tokenize sentence, add special tokens, and map all tokens to their ids
+            tokens = self._preprocess_sentence(sentence)
+            sequences.append(store.intern(tokens))
+            # Update token count
+            token_count += len(tokens)
+            buffer_size += len(tokens)
+            # Count n-grams chunk by chunk to limit the memory needed for the token id sequences
+            if buffer_size >= self.chunk_size:
+                store.add_sequences(sequences)
+                sequences, buffer_size = [], 0
+        store.add_sequences(sequences)
+        return token_count
+
+    def _count_sentences_parallel(self, sentences, n_jobs, shard_size):
+        # Each worker gets a copy of the model without any counts
+        worker_model = copy.copy(self)
+        worker_model.reset()
+        shards = ( (worker_model, shard) for shard in _batched(sentences, shard_size) )
+        with multiprocessing.Pool(n_jobs) as pool, tqdm(total=len(sentences) if hasattr(sentences, "__len__") else None) as pbar:
+            for id2token, ngrams, counts, token_count, num_sentences in pool.imap(_count_shard, shards):
+                # Map the token ids of the shard to the token ids of the model and add the counts
+                mapping = np.asarray(self.store.intern(id2token), dtype=np.int32)
+                self.store.add_ngrams(mapping[ngrams], counts)
+                self.token_count += token_count
+                pbar.update(num_sentences)
+
+    def train(self, sentences: list[str], n_jobs: int = 1, shard_size: int = 100_000):
+        self.reset()
+        self.update(sentences, n_jobs=n_jobs, shard_size=shard_size)
+
+    def update(self, sentences, n_jobs: int = 1, shard_size: int = 100_000):
+        # The sentences can be any iterable (e.g., a generator or map(str.strip, file)) and are processed
+        # chunk by chunk; all counts are added to the existing ones (i.e., no reset)
+        if self.ngram_codes is not None:
+            raise ValueError("A quantized model cannot be updated")
+        # Pruning drops the counts of the pruned n-grams, so the original context counts could not be recomputed
+        if any(store is not None and store.context_pruned_counts is not None for store in self.order_stores):
+            raise ValueError("A pruned model cannot be updated")
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        # Count all n-grams, either directly or by distributing shards of sentences across worker processes
+        if n_jobs == 1:
+            self.token_count += self._count_sentences(tqdm(sentences), self.store)
+        else:
+            self._count_sentences_parallel(sentences, n_jobs, shard_size)
+        # Create index for fast lookups (includes all previously indexed n-grams)
+        self.store.build()
+        if self.smoothing != self.SMOOTHING__ADD_K:
+            self._build_order_tables()
+        # Cached distributions are no longer valid after the update
+        self.distribution_cache.clear()
+
+    def _estimate_discount(self, counts):
+        if self.discount is not None:
+            return self.discount
+        # Estimate discount from the number of n-grams seen once and twice (Ney et al.)
+        n1, n2 = np.count_nonzero(counts == 1), np.count_nonzero(counts == 2)
+        return float(n1 / (n1 + 2*n2)) if n1 > 0 and n2 > 0 else 0.75
+
+    def _build_order_tables(self):
+        # The n-grams of order N are the n-grams in the main store
+        ngrams, counts = self.store.decode_ngrams(), self.store.ngram_counts
+        self.discounts[self.N] = self._estimate_discount(counts)
+        # Derive the (m)-grams from the suffixes of the (m+1)-grams, from order N-1 down to 1
+        for m in range(self.N-1, 0, -1):
+            if self.smoothing == self.SMOOTHING__KNESER_NEY:
+                # Continuation count: number of distinct words preceding an m-gram (each (m+1)-gram is distinct)
+                ngrams, counts = _unique_ngrams(ngrams[:, 1:], np.ones(len(ngrams), dtype=np.int64))
+            else:
+                # Raw count: each position in a sentence is the end of exactly one n-gram of order N
+                ngrams, counts = _unique_ngrams(ngrams[:, 1:], counts)
+            self.discounts[m] = self._estimate_discount(counts)
+            if m == 1:
+                # Unigrams are kept as a dense array indexed by token id
+                self.unigram_counts = np.bincount(ngrams[:, 0], weights=counts, minlength=len(self.vocab)).astype(np.int64)
+            else:
+                # All stores share the same vocabulary (and with that the same token ids)
+                store = NGramCountStore(m)
+                store.token2id, store.id2token = self.store.token2id, self.store.id2token
+                store.add_ngrams(ngrams, counts)
+                self.order_stores[m] = store.build()
+
+    def _get_order_counts(self, m, ngram_ids):
+        # For a quantized model, the counts of order N are dropped (only needed for unseen n-grams anyway)
+        if m == self.N and self.ngram_codes is not None:
+            return np.zeros(len(ngram_ids), dtype=np.int64)
+        return self.order_stores[m].get_ngram_counts(ngram_ids)
+
+    def _compute_kneser_ney_probabilities(self, ngram_ids, max_order=None):
+        # Order 1: continuation probability interpolated with the uniform distribution over the vocabulary
+        counts = _gather(self.unigram_counts, np.where(ngram_ids[:, -1] < len(self.unigram_counts), ngram_ids[:, -1], -1))
+        total, discount = self.unigram_counts.sum(), self.discounts[1]
+        probs = (np.maximum(counts - discount, 0) + discount * np.count_nonzero(self.unigram_counts) / len(self.vocab)) / total
+        # Orders 2..N: interpolate discounted (continuation) counts with the probabilities of the lower order
+        for m in range(2, (max_order or self.N)+1):
+            ngrams, discount = ngram_ids[:, self.N-m:], self.discounts[m]
+            counts = self._get_order_counts(m, ngrams)
+            context_counts, followers, pruned_counts = self.order_stores[m].get_context_stats(ngrams[:, :-1])
+            # The mass of pruned n-grams goes to the lower order (keeps the distribution normalized)
+            backoff_mass = discount * followers + pruned_counts
+            # For unseen contexts, the probability of the lower order is used directly
+            probs = np.where(context_counts > 0,
+                             (np.maximum(counts - discount, 0) + backoff_mass * probs) / np.maximum(context_counts, 1),
+                             probs)
+        return probs
+
+    def _compute_stupid_backoff_scores(self, ngram_ids, max_order=None):
+        scores, resolved, weight = np.zeros(len(ngram_ids)), np.zeros(len(ngram_ids), dtype=bool), 1.0
+        # Use the relative frequency of the highest order for which the n-gram has been seen
+        for m in range((max_order or self.N), 1, -1):
+            ngrams = ngram_ids[:, self.N-m:]
+            counts = self._get_order_counts(m, ngrams)
+            hits = ~resolved & (counts > 0)
+            scores[hits] = weight * counts[hits] / self.order_stores[m].get_context_counts(ngrams[hits, :-1])
+            resolved |= hits
+            weight *= self.alpha
+        # All other n-grams back off to the (add-k smoothed) unigram frequency
+        counts = _gather(self.unigram_counts, np.where(ngram_ids[:, -1] < len(self.unigram_counts), ngram_ids[:, -1], -1))
+        scores[~resolved] = weight * (counts[~resolved] + self.k) / (self.unigram_counts.sum() + self.k * len(self.vocab))
+        return scores
+
+    def _compute_ngram_probabilities(self, ngram_ids):
+        # Compute the probabilities of all n-grams (rows of token ids; -1 for unknown tokens) at once
+        ngram_ids = np.atleast_2d(np.asarray(ngram_ids, dtype=np.int64))
+        if self.ngram_codes is not None:
+            # For a quantized model, the probabilities of all seen n-grams are looked up from the codebook
+            indices = self.store.lookup(ngram_ids)
+            seen = indices >= 0
+            probs = np.empty(len(ngram_ids))
+            probs[seen] = np.exp(self.codebook[self.ngram_codes[indices[seen]]])
+            probs[~seen] = self._compute_smoothed_probabilities(ngram_ids[~seen])
+            return probs
+        return self._compute_smoothed_probabilities(ngram_ids)
+
+    def _compute_smoothed_probabilities(self, ngram_ids, max_order=None):
+        if self.smoothing == self.SMOOTHING__KNESER_NEY:
+            return self._compute_kneser_ney_probabilities(ngram_ids, max_order=max_order)
+        elif self.smoothing == self.SMOOTHING__STUPID_BACKOFF:
+            return self._compute_stupid_backoff_scores(ngram_ids, max_order=max_order)
+        # Add-k smoothing: relative frequency of the n-gram given its context
+        numerators = self._get_order_counts(self.N, ngram_ids) + self.k
+        denominators = self.store.get_context_counts(ngram_ids[:, :-1]) + self.k * len(self.vocab)
+        return numerators / denominators
+
+    ###############################################################################################
+    ### Pruning & Quantization
+    ###############################################################################################
+
+    def nbytes(self):
+        # Memory used by all count, index and probability arrays (excluding the vocabulary)
+        arrays = [self.unigram_counts, self.ngram_codes, self.codebook]
+        return sum(s.nbytes() for s in self.order_stores if s is not None) + sum(a.nbytes for a in arrays if a is not None)
+
+    def prune(self, min_count: int = 2):
+        if self.ngram_codes is not None:
+            raise ValueError("A quantized model cannot be pruned")
+        # Remove all n-grams of orders 2..N seen less than min_count times (unigrams are never pruned)
+        stores = self.order_stores[2:] if self.smoothing != self.SMOOTHING__ADD_K else [self.store]
+        for store in stores:
+            store.prune(store.ngram_counts >= min_count)
+        self.distribution_cache.clear()
+        return self
+
+    def prune_entropy(self, threshold: float):
+        if self.ngram_codes is not None:
+            raise ValueError("A quantized model cannot be pruned")
+        # Remove n-grams of order N whose removal changes the model the least (Stolcke): the score of an
+        # n-gram is its relative frequency times the log ratio of its probability and its backoff probability
+        ngrams = self.store.decode_ngrams()
+        counts = self.store.ngram_counts
+        probs = self._compute_smoothed_probabilities(ngrams)
+        if self.smoothing == self.SMOOTHING__KNESER_NEY:
+            context_counts, followers, pruned_counts = self.store.get_context_stats(ngrams[:, :-1])
+            backoff_mass = self.discounts[self.N] * followers + pruned_counts + np.maximum(counts - self.discounts[self.N], 0)
+            backoff_probs = backoff_mass / context_counts * self._compute_smoothed_probabilities(ngrams, max_order=self.N-1)
+        elif self.smoothing == self.SMOOTHING__STUPID_BACKOFF:
+            backoff_probs = self.alpha * self._compute_smoothed_probabilities(ngrams, max_order=self.N-1)
+        else:
+            backoff_probs = self.k / (self.store.get_context_counts(ngrams[:, :-1]) + self.k * len(self.vocab))
+        scores = counts / counts.sum() * (np.log(probs) - np.log(backoff_probs))
+        self.store.prune(scores >= threshold)
+        self.distribution_cache.clear()
+        return self
+
+    def quantize(self, bits: int = 8):
+        if bits not in (8, 16):
+            raise ValueError("Only 8-bit and 16-bit quantization is supported")
+        if self.ngram_codes is not None:
+            raise ValueError("The model is already quantized")
+        # Compute the (exact) log probabilities of all n-grams of order N
+        log_probs = np.log(self._compute_smoothed_probabilities(self.store.decode_ngrams()))
+        # Quantile binning: each bin holds the same number of n-grams and is represented by its mean log probability
+        num_bins = 1 << bits
+        edges = np.quantile(log_probs, np.linspace(0, 1, num_bins+1)[1:-1]) if len(log_probs) > 0 else np.empty(0)
+        codes = np.searchsorted(edges, log_probs)
+        self.codebook = np.bincount(codes, weights=log_probs, minlength=num_bins) / np.maximum(np.bincount(codes, minlength=num_bins), 1)
+        self.ngram_codes = codes.astype(np.uint8 if bits == 8 else np.uint16)
+        # The counts of order N are no longer needed
+        self.store.ngram_counts = None
+        self.distribution_cache.clear()
+        return self
+
+    def compress(self, max_bytes: int, bits: int = None):
+        # Check all arguments before pruning the model (which cannot be undone)
+        if bits not in (None, 8, 16):
+            raise ValueError("Only 8-bit and 16-bit quantization is supported")
+        if self.ngram_codes is not None:
+            raise ValueError("The model is already quantized")
+        # Find the smallest count threshold so that the (optionally quantized) model fits into max_bytes
+        stores = self.order_stores[2:] if self.smoothing != self.SMOOTHING__ADD_K else [self.store]
+        # Memory not affected by pruning, plus the codebook (one log probability for each quantization bin)
+        fixed_bytes = self.nbytes() - sum(s.nbytes() for s in stores) + ((1 << bits) * 8 if bits is not None else 0)
+        # With quantization, the counts of order N are replaced by 8-bit or 16-bit codes
+        count_bytes = [ bits//8 if s is self.store and bits is not None else 8 for s in stores ]
+        estimate = lambda t: fixed_bytes + sum(s.estimate_nbytes(s.ngram_counts >= t, b) for s, b in zip(stores, count_bytes))
+        max_count = max(int(s.ngram_counts.max()) for s in stores if len(s.ngram_counts) > 0)
+        low, high = 1, max_count + 1
+        while low < high:
+            mid = (low + high) // 2
+            if estimate(mid) <= max_bytes:
+                high = mid
+            else:
+                low = mid + 1
+        if estimate(low) > max_bytes:
+            raise ValueError(f"The model cannot be compressed to {max_bytes} bytes")
+        if low > 1:
+            self.prune(min_count=low)
+        if bits is not None:
+            self.quantize(bits=bits)
+        return self
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        config = {
+            "format_version": self.FORMAT_VERSION,
+            "N": self.N, "k": self.k, "lowercase": self.lowercase,
+            "smoothing": self.smoothing, "discount": self.discount, "alpha": self.alpha,
+            "token_count": self.token_count, "discounts": self.discounts, "quantized": self.ngram_codes is not None,
+            # Only the built-in tokenizers can be restored by name
+            "tokenizer": next((name for name, t in TOKENIZERS.items() if t is self.tokenizer), None),
+        }
+        with open(os.path.join(path, "model.json"), "w") as f:
+            json.dump(config, f)
+        # The vocabulary is shared by all stores, so it is only saved once
+        with open(os.path.join(path, "vocab.json"), "w") as f:
+            json.dump(self.store.id2token, f)
+        self.store.save(path, "store")
+        if self.smoothing != self.SMOOTHING__ADD_K:
+            for m in range(2, self.N):
+                self.order_stores[m].save(path, f"store{m}")
+            np.save(os.path.join(path, "unigram_counts.npy"), self.unigram_counts)
+        if self.ngram_codes is not None:
+            np.save(os.path.join(path, "ngram_codes.npy"), self.ngram_codes)
+            np.save(os.path.join(path, "codebook.npy"), self.codebook)
+        return path
+
+    @classmethod
+    def load(cls, path, mmap_mode="r", tokenizer=None):
+        with open(os.path.join(path, "model.json")) as f:
+            config = json.load(f)
+        if config["format_version"] != cls.FORMAT_VERSION:
+            raise ValueError(f"Unsupported format version: {config['format_version']}")
+        # A custom tokenizer cannot be saved, so it needs to be specified again when loading the model
+        if tokenizer is None:
+            if config["tokenizer"] is None:
+                raise ValueError("The model was trained with a custom tokenizer; please specify the tokenizer")
+            tokenizer = config["tokenizer"]
+        model = cls(N=config["N"], k=config["k"], lowercase=config["lowercase"], tokenizer=tokenizer,
+                    smoothing=config["smoothing"], discount=config["discount"], alpha=config["alpha"])
+        model.token_count = config["token_count"]
+        # Load the vocabulary and all stores (all count and index arrays are memory-mapped by default)
+        with open(os.path.join(path, "vocab.json")) as f:
+            id2token = json.load(f)
+        model.store = NGramCountStore.load(path, "store", mmap_mode=mmap_mode)
+        model.store.id2token = id2token
+        model.store.token2id = { t: i for i, t in enumerate(id2token) }
+        model.vocab = model.store.token2id
+        if model.smoothing != cls.SMOOTHING__ADD_K:
+            for m in range(2, model.N):
+                model.order_stores[m] = NGramCountStore.load(path, f"store{m}", mmap_mode=mmap_mode)
+                model.order_stores[m].token2id, model.order_stores[m].id2token = model.store.token2id, id2token
+            model.unigram_counts = np.load(os.path.join(path, "unigram_counts.npy"), mmap_mode=mmap_mode)
+            model.discounts = config["discounts"]
+        if config["quantized"]:
+            model.ngram_codes = np.load(os.path.join(path, "ngram_codes.npy"), mmap_mode=mmap_mode)
+            model.codebook = np.load(os.path.join(path, "codebook.npy"))
+        model.order_stores[model.N] = model.store
+        return model
+
+    def get_ngram_count(self, ngram):
+        return int(self.store.get_ngram_counts(self.store.encode(ngram))[0])
+
+    def get_context_count(self, context):
+        return int(self.store.get_context_counts(self.store.encode(context))[0])
+
+    def compute_ngram_probability(self, word, context):
+        # Shorten context if needed
+        context = tuple(context[-(self.N-1):]) if self.N > 1 else tuple()
+        # Map n-gram to token ids; a too short context is padded with unknown tokens (i.e., an unseen context)
+        ngram_ids = self.store.encode(context + (word,))
+        ngram_ids = np.concatenate([np.full(self.N-len(ngram_ids), -1), ngram_ids])
+        return float(self._compute_ngram_probabilities(ngram_ids)[0])
+
+    def score(self, sentences, batch_size: int = 100_000):
+        log_probs, total_tokens = [], 0
+        token2id = self.store.token2id
+        for batch in _batched(sentences, batch_size):
+            # Tokenize each sentence only once and map all tokens to their ids (unknown tokens are mapped to -1)
+            sequences = [ [ token2id.get(t, -1) for t in self._preprocess_sentence(s) ] for s in batch ]
+            total_tokens += sum(len(seq) for seq in sequences)
+            # Compute the smoothed log probabilities of all n-grams of the batch at once
+            ngrams = _extract_ngrams(sequences, self.N)
+            ngram_log_probs = np.log(self._compute_ngram_probabilities(ngrams))
+            # Sum up the log probabilities for each sentence (a sentence with L tokens has L-N+1 n-grams)
+            sentence_indices = np.repeat(np.arange(len(sequences)), [ len(seq)-self.N+1 for seq in sequences ])
+            log_probs.append(np.bincount(sentence_indices, weights=ngram_log_probs, minlength=len(sequences)))
+        log_probs = np.concatenate(log_probs) if len(log_probs) > 0 else np.empty(0)
+        # Return the log probability of each sentence and the perplexity of all sentences
+        return log_probs, np.exp(-log_probs.sum() / total_tokens)
+
+    def compute_sentence_log_probability(self, sentence):
+        return self.score([sentence])[0][0]
+
+    def perplexity(self, sentences):
+        return self.score(sentences)[1]
+
+    def _get_next_word_distribution(self, context):
+        # Get all candidate words for the context; if there are none (e.g., after pruning), use the candidate
+        # words for the longest shorter context (only available for Kneser-Ney smoothing and Stupid Backoff)
+        context_ids = self.store.encode(context)
+        word_ids = np.empty(0, dtype=np.int64)
+        for m in range(self.N, 1, -1):
+            if self.order_stores[m] is not None and len(word_ids) == 0:
+                word_ids, _ = self.order_stores[m].get_candidates(context_ids[self.N-m:])
+        if len(word_ids) == 0:
+            raise KeyError(tuple(context))
+        # Compute the probabilities of all candidate words at once
+        ngram_ids = np.column_stack([np.tile(context_ids, (len(word_ids), 1)), word_ids])
+        return np.asarray(self.store.decode(word_ids)), self._compute_ngram_probabilities(ngram_ids)
+
+
+
+
+
+def _get_bigram_counts(model, tokens):
+    # Map each token to its column; only the observed successors of each token need to be checked
+    columns = { t: j for j, t in enumerate(tokens) }
+    rows, cols, counts = [], [], []
+    for i, t in enumerate(tokens):
+        for w in model.contexts.get((t,), ()):
+            if w in columns:
+                rows.append(i)
+                cols.append(columns[w])
+                counts.append(model.ngram_counts[(t, w)])
+    context_counts = np.asarray([ model.get_context_count((t,)) for t in tokens ], dtype=np.int64)
+    return np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64), np.asarray(counts, dtype=np.int64), context_counts
+
+
+def _get_compact_bigram_counts(model, tokens):
+    store = model.store
+    ids = store.encode(tokens)
+    context_counts = store.get_context_counts(ids[:, None])
+    # Only models with N=2 have bigram counts, and a quantized model has no n-gram counts anymore (its probabilities
+    # are computed from the quantized log probabilities in _compute_bigram_probabilities())
+    if model.N != 2 or store.ngram_counts is None:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, context_counts
+    # Get the range of bigrams for each token (as context) found in the store
+    contexts = store.lookup(ids[:, None])
+    rows = np.flatnonzero(contexts >= 0)
+    starts, ends = store.context_offsets[contexts[rows]], store.context_offsets[contexts[rows]+1]
+    lengths = ends - starts
+    # Enumerate the positions of all bigrams of all ranges at once
+    rows = np.repeat(rows, lengths)
+    positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+    # Map the id of each successor word to its column (-1 if the word is not one of the tokens)
+    columns = np.full(len(store.id2token), -1, dtype=np.int64)
+    columns[ids[ids >= 0]] = np.flatnonzero(ids >= 0)
+    cols = columns[store.keys[-1][positions] & ((1 << store.wbits) - 1)]
+    keep = cols >= 0
+    return rows[keep], cols[keep], store.ngram_counts[positions[keep]], context_counts
+
+
+def _compute_bigram_probabilities(model, tokens, bigram_counts, context_counts):
     n = len(tokens)
-    pairs = np.asarray(list(product(tokens, repeat=2))).reshape(n, n, 2)
-
-    data_unigrams = np.zeros((1, n))
-    for idx, unigram in enumerate(tokens):
-        if mode.lower() == 'counts':
-            data_unigrams[0,idx] = int(model.context_counts[(unigram, )])
-        if mode.lower() == 'probs':
-            data_unigrams[0,idx] = np.round(model.context_counts[(unigram, )] / model.token_count, decimals=decimals)
-    
-    data_bigrams  = np.zeros((n, n))   
-    for row_idx, row in enumerate(pairs):
-        for col_idx, bigram in enumerate(row):
-            bigram = tuple(bigram)
-            if mode.lower() == 'counts':
-                data_bigrams[row_idx,col_idx] = int(model.ngram_counts[bigram])
-            elif mode.lower() == 'probs':
-                data_bigrams[row_idx,col_idx] = np.round(model.compute_ngram_probability(bigram[1], (bigram[0],)), decimals=decimals)
+    if isinstance(model, CompactNGramLanguageModel) and (model.smoothing != model.SMOOTHING__ADD_K or model.ngram_codes is not None):
+        # Compute the probabilities of all pairs at once (contexts are padded like in compute_ngram_probability())
+        ids = model.store.encode(tokens)
+        ngram_ids = np.column_stack([np.full((n*n, model.N-2), -1), np.repeat(ids, n), np.tile(ids, n)])
+        return model._compute_ngram_probabilities(ngram_ids).reshape(n, n)
+    # Add-k smoothing: relative frequency of the bigram given its context
+    return (bigram_counts.toarray() + model.k) / (context_counts[:, None] + model.k * len(model.vocab))
+
+
+def generate_bigram_data(model, tokens, mode='counts', decimals=4, sparse=False):
+    mode = mode.lower()
+    # Compute everything for the unique tokens only and expand the results at the end
+    unique_tokens, inverse = np.unique(np.asarray(tokens, dtype=object), return_inverse=True)
+    n = len(unique_tokens)
+    # Get all bigram counts (as a sparse matrix) and context counts straight from the count store
+    if isinstance(model, CompactNGramLanguageModel):
+        if mode == 'counts' and model.ngram_codes is not None:
+            raise ValueError("The bigram counts are no longer available after quantization; use mode='probs' instead")
+        rows, cols, counts, context_counts = _get_compact_bigram_counts(model, list(unique_tokens))
+    else:
+        rows, cols, counts, context_counts = _get_bigram_counts(model, list(unique_tokens))
+    data_bigrams = scipy.sparse.csr_matrix((counts, (rows, cols)), shape=(n, n), dtype=np.int64)
 
     if mode == 'counts':
-        data_bigrams  = data_bigrams.astype(int)
-        data_unigrams = data_unigrams.astype(int)
-    
-    df_bigrams  = pd.DataFrame(data_bigrams,  columns=tokens, index=tokens)
+        data_unigrams = context_counts.reshape(1, n)
+    elif mode == 'probs':
+        data_unigrams = np.round(context_counts.reshape(1, n) / model.token_count, decimals=decimals)
+        data_bigrams  = np.round(_compute_bigram_probabilities(model, unique_tokens, data_bigrams, context_counts), decimals=decimals)
+
+    # Expand results to the original tokens (which might contain duplicates)
+    data_unigrams = data_unigrams[:, inverse]
+    data_bigrams  = data_bigrams[inverse][:, inverse]
+
+    if sparse is True:
+        df_bigrams = pd.DataFrame.sparse.from_spmatrix(scipy.sparse.csr_matrix(data_bigrams), columns=tokens, index=tokens)
+    else:
+        df_bigrams = pd.DataFrame(data_bigrams.toarray() if scipy.sparse.issparse(data_bigrams) else data_bigrams, columns=tokens, index=tokens)
     df_unigrams = pd.DataFrame(data_unigrams, columns=tokens, index=[mode])
 
-    return df_bigrams, df_unigrams
\ No newline at end of file
+    return df_bigrams, df_unigrams
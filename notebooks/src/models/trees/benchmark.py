@@ -0,0 +1,173 @@
+import sys
+import time
+import resource
+import multiprocessing
+import numpy as np
+import pandas as pd
+from itertools import product
+from sklearn.datasets import make_classification, make_regression
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+from sklearn.metrics import accuracy_score, r2_score
+from sklearn.tree import DecisionTreeClassifier, DecisionTreeRegressor
+
+from src.models.trees.cart import SeleneCART
+from src.models.trees.dtree import SeleneDecisionTreeClassifier, SeleneDecisionTreeRegressor
+from src.models.trees.rf import SeleneRandomForestClassifier, SeleneRandomForestRegressor
+
+
+###############################################################################################
+### Synthetic Datasets
+###############################################################################################
+
+def make_dataset(n_samples: int, n_features: int, n_nominal: int=0, n_categories: int=10, task: str="classification", random_state: int=0):
+    rng = np.random.RandomState(random_state)
+    # Generate numerical features where (at most) 5 features are informative
+    n_informative = min(n_features, 5)
+    if task == "classification":
+        X, y = make_classification(n_samples=n_samples, n_features=n_features, n_informative=n_informative, n_redundant=0,
+                                   n_classes=3, n_clusters_per_class=1, random_state=random_state)
+    elif task == "regression":
+        X, y = make_regression(n_samples=n_samples, n_features=n_features, n_informative=n_informative, noise=10.0, random_state=random_state)
+    else:
+        raise ValueError(f"Unknown task: {task}")
+    # Turn the first n_nominal features into nominal features with n_categories categories each; the categories are the
+    # quantiles of the original values but get random codes, so that the order of the codes carries no information
+    for fidx in range(min(n_nominal, n_features)):
+        quantiles = np.quantile(X[:,fidx], np.linspace(0, 1, n_categories+1)[1:-1])
+        X[:,fidx] = rng.permutation(n_categories)[np.searchsorted(quantiles, X[:,fidx])]
+    feature_types = [ "nominal" if fidx < n_nominal else "ratio" for fidx in range(n_features) ]
+    # Return features, targets, and the feature types (as required by SeleneCART)
+    return X, y, feature_types
+
+
+###############################################################################################
+### Engines
+###############################################################################################
+
+def get_engines(task: str, feature_types: list, max_depth: int=None, max_bins: int=256, n_estimators: int=20, max_features: int=None,
+                n_jobs: int=1, random_state: int=0):
+    # Each engine is a function returning a new (unfitted) model, so that each measurement starts from scratch;
+    # nominal features are treated as ordinal features by all engines except SeleneCART
+    # All forests consider the same number of features at each split (by default, the square root of the number of features
+    # as for max_features="sqrt" in sklearn, which SeleneRandomForest does not support)
+    if max_features is None:
+        max_features = max(1, int(np.sqrt(len(feature_types))))
+    if task == "classification":
+        return {
+            "selene-tree":           lambda: SeleneDecisionTreeClassifier(max_depth=max_depth, random_state=random_state),
+            "selene-tree-binned":    lambda: SeleneDecisionTreeClassifier(max_depth=max_depth, max_bins=max_bins, random_state=random_state),
+            "selene-cart-binned":    lambda: SeleneCART(feature_types, max_depth=max_depth, max_bins=max_bins),
+            "selene-forest":         lambda: SeleneRandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, max_features=max_features,
+                                                                          n_jobs=n_jobs, random_state=random_state),
+            "selene-forest-binned":  lambda: SeleneRandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, max_features=max_features,
+                                                                          max_bins=max_bins, n_jobs=n_jobs, random_state=random_state),
+            "sklearn-tree":          lambda: DecisionTreeClassifier(max_depth=max_depth, random_state=random_state),
+            "sklearn-forest":        lambda: RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, max_features=max_features,
+                                                                    n_jobs=n_jobs, random_state=random_state),
+        }
+    elif task == "regression":
+        return {
+            "selene-tree":           lambda: SeleneDecisionTreeRegressor(max_depth=max_depth, random_state=random_state),
+            "selene-tree-binned":    lambda: SeleneDecisionTreeRegressor(max_depth=max_depth, max_bins=max_bins, random_state=random_state),
+            "selene-forest":         lambda: SeleneRandomForestRegressor(n_estimators=n_estimators, max_depth=max_depth, max_features=max_features,
+                                                                         n_jobs=n_jobs, random_state=random_state),
+            "selene-forest-binned":  lambda: SeleneRandomForestRegressor(n_estimators=n_estimators, max_depth=max_depth, max_features=max_features,
+                                                                         max_bins=max_bins, n_jobs=n_jobs, random_state=random_state),
+            "sklearn-tree":          lambda: DecisionTreeRegressor(max_depth=max_depth, random_state=random_state),
+            "sklearn-forest":        lambda: RandomForestRegressor(n_estimators=n_estimators, max_depth=max_depth, max_features=max_features,
+                                                                   n_jobs=n_jobs, random_state=random_state),
+        }
+    else:
+        raise ValueError(f"Unknown task: {task}")
+
+
+###############################################################################################
+### Measurements
+###############################################################################################
+
+def _fit_peak_memory(task, feature_types, engine, engine_params, X_train, y_train):
+    # Runs in a fresh process: the increase of the peak resident set size during fitting covers all memory of the process,
+    # including the memory allocated by native code (e.g., by sklearn) and not only NumPy arrays
+    model = get_engines(task, feature_types, **engine_params)[engine]()
+    # The peak so far (e.g., from importing all modules) may be higher than the peak while fitting; on Linux, the peak
+    # can be reset to the current resident set size, otherwise the result is a lower bound
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    model.fit(X_train, y_train)
+    peak_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in kilobytes on Linux but in bytes on macOS
+    return (peak_after - peak_before) * (1 if sys.platform == "darwin" else 1024)
+
+
+def measure_peak_memory(task, feature_types, engine, X_train, y_train, **engine_params):
+    # Measure the peak memory during fitting in a separate process, so that the memory used by earlier runs does not hide
+    # the peak of this run; this does not include the memory of worker processes (i.e., for n_jobs > 1). The process is
+    # forked from the (small) fork server since a spawned process would inherit the peak memory of this process
+    with multiprocessing.get_context("forkserver").Pool(1) as pool:
+        return pool.apply(_fit_peak_memory, (task, feature_types, engine, engine_params, X_train, y_train))
+
+
+def benchmark_engine(create_model, X_train, y_train, X_test, y_test, task: str="classification", n_repeats: int=1):
+    # Measure the fit time (best of n_repeats runs to reduce the noise)
+    fit_time = np.inf
+    for _ in range(n_repeats):
+        model = create_model()
+        start = time.perf_counter()
+        model.fit(X_train, y_train)
+        fit_time = min(fit_time, time.perf_counter() - start)
+    # Measure the predict time of the last fitted model
+    predict_time = np.inf
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        y_pred = model.predict(X_test)
+        predict_time = min(predict_time, time.perf_counter() - start)
+    # Accuracy for classification, R^2 for regression
+    score = accuracy_score(y_test, y_pred) if task == "classification" else r2_score(y_test, y_pred)
+    return { "fit_time": fit_time, "predict_throughput": len(X_test) / predict_time, "score": score }
+
+
+def run_benchmark(n_samples_list=(1_000, 10_000), n_features_list=(10,), n_nominal: int=0, n_categories_list=(10,), task: str="classification",
+                  engines: list=None, test_size: float=0.25, n_repeats: int=1, measure_memory: bool=True, verbose: bool=True, **engine_params):
+    results = []
+    # Run all engines on each combination of dataset size, number of features, and number of categories
+    for n_samples, n_features, n_categories in product(n_samples_list, n_features_list, n_categories_list):
+        n_train = int(n_samples * (1 - test_size))
+        X, y, feature_types = make_dataset(int(n_samples), n_features, n_nominal=n_nominal, n_categories=n_categories, task=task)
+        X_train, y_train, X_test, y_test = X[:n_train], y[:n_train], X[n_train:], y[n_train:]
+        for name, create_model in get_engines(task, feature_types, **engine_params).items():
+            if engines is not None and name not in engines:
+                continue
+            result = benchmark_engine(create_model, X_train, y_train, X_test, y_test, task=task, n_repeats=n_repeats)
+            peak_memory = measure_peak_memory(task, feature_types, name, X_train, y_train, **engine_params) if measure_memory == True else np.nan
+            result = { "engine": name, "n_samples": int(n_samples), "n_features": n_features, "n_categories": n_categories,
+                       "peak_memory_mb": peak_memory / 2**20, **result }
+            if verbose == True:
+                print(f"{name:>20} | n={int(n_samples):>8} | d={n_features:>3} | k={n_categories:>4} | fit: {result['fit_time']:8.3f}s | "
+                      f"predict: {result['predict_throughput']:12.0f}/s | memory: {result['peak_memory_mb']:8.1f}MB | score: {result['score']:.3f}")
+            results.append(result)
+    # Return all results as a DataFrame (one row per engine and dataset)
+    return pd.DataFrame(results)
+
+
+def compare_to_baseline(results: pd.DataFrame, baseline: str="sklearn-tree"):
+    # Express fit time, predict throughput, and peak memory of all engines relative to the baseline on the same dataset
+    keys = ["n_samples", "n_features", "n_categories"]
+    columns = ["fit_time", "predict_throughput", "peak_memory_mb", "score"]
+    baseline_results = results[results["engine"] == baseline][keys + columns]
+    merged = results.merge(baseline_results, on=keys, suffixes=("", "_baseline"))
+    for col in columns[:-1]:
+        merged[f"{col}_ratio"] = merged[col] / merged[f"{col}_baseline"]
+    merged["score_diff"] = merged["score"] - merged["score_baseline"]
+    return merged[["engine"] + keys + [ f"{col}_ratio" for col in columns[:-1] ] + ["score_diff"]]
+
+
+
+if __name__ == "__main__":
+    # Run from the notebooks/ directory: python -m src.models.trees.benchmark
+    for task in ["classification", "regression"]:
+        results = run_benchmark(n_samples_list=(1_000, 5_000), n_features_list=(10,), n_nominal=2, n_categories_list=(5, 50), task=task, max_depth=12)
+        print(compare_to_baseline(results).to_string(index=False))
@@ -1,5 +1,8 @@
+import os
+import json
 import numpy as np
 from itertools import chain, combinations
+from src.models.trees.dtree import predict_in_chunks
 
 
 
@@ -8,14 +11,21 @@ class Node():
     Implements an individual node in the Decision Tree. 
     """      
     
-    def __init__(self, y):
-        self.y = y                 # Labels of sample assigned to that node
+    def __init__(self, indices, targets):
+        self.indices = indices     # Indices of samples assigned to that node (view into the index array shared by all nodes)
+        self.targets = targets     # Labels of all training samples (shared by all nodes)
+        self.value = None          # Class counts of the node
         self.score = np.inf        # Gini score of the node (measure of impurity)
         self.feature_col = None    # The feature used for the split (column number)
         self.criterion = None      # Threshold used of the splot (scalar value)
         self.left_child = None     # Left child of the node (of type Node)
         self.right_child = None    # Right child of the node (of type Node)
         
+    @property
+    def y(self):
+        # Labels of samples assigned to that node (only extracted when needed)
+        return self.targets[np.sort(self.indices)]
+
     def is_leaf(self):
         if self.feature_col is None:
             return True
@@ -31,19 +41,36 @@ class Node():
 
 
 class SeleneCART:
+
+    FORMAT_VERSION = 1
     
-    def __init__(self, feature_types, max_depth=None, min_samples_split=2):
+    def __init__(self, feature_types, max_depth=None, min_samples_split=2, max_bins=None, max_exhaustive_categories=10):
         
         ## Just a check if the parameter values are meaningful
         if max_depth is not None and max_depth < 1:
             raise Exception('If specified, max_depth must be greater or equal to 0')
         if min_samples_split is not None and min_samples_split < 1:
             raise Exception('If specified, min_samples_split must be greater or equal to 0')
+        if max_bins is not None and (max_bins < 2 or max_bins > 256):
+            raise Exception('If specified, max_bins must be between 2 and 256')
+        if max_exhaustive_categories < 2:
+            raise Exception('max_exhaustive_categories must be greater or equal to 2')
             
         self.tree = None
         self.feature_types = feature_types
         self.max_depth = max_depth
         self.min_samples_split = min_samples_split
+        self.max_bins = max_bins
+        # Maximum number of categories of a nominal feature for which all partitions are checked (only for >2 classes)
+        self.max_exhaustive_categories = max_exhaustive_categories
+        self.bin_thresholds = None
+        self.classes = None
+        # Mapping of each known category of nominal features to an integer code
+        self.category_codes = None
+        # Flattened representation of the tree as parallel arrays (index = node id, root = 0)
+        self.feature_cols, self.thresholds, self.left_children, self.right_children, self.values = None, None, None, None, None
+        # For nominal features, a lookup table which category codes go into the left child
+        self.left_masks = None
     
     
     def compute_gini_score_node(self, y):
@@ -60,6 +87,35 @@ class SeleneCART:
         # Calculate and return the weighted average Gini score
         return   len(y_left)/(len(y_left)+len(y_right))*gini_score_left \
                + len(y_right)/(len(y_left)+len(y_right))*gini_score_right  
+
+
+    def compute_node_value(self, y):
+        # Summarize the node by its class counts (w.r.t. all classes of the training data)
+        return np.bincount(np.searchsorted(self.classes, y), minlength=len(self.classes))
+
+
+    def compute_gini_stats(self, y):
+        # The statistics of a sample is its one-hot class vector (sums of those vectors are class counts)
+        _, codes = np.unique(y, return_inverse=True)
+        one_hot = np.zeros((len(y), codes.max()+1))
+        one_hot[np.arange(len(y)), codes] = 1
+        return one_hot
+
+
+    def compute_gini_scores_counts(self, counts_left, counts_right):
+        # Compute the weighted Gini scores of many splits at once given the class counts of the left and right child (one row per split)
+        n_left, n_right = np.sum(counts_left, axis=-1), np.sum(counts_right, axis=-1)
+        # Since len(y_left)*gini(y_left) = len(y_left) - sum(counts_left^2)/len(y_left) (same for the right child)
+        gini_left  = n_left - np.sum(np.square(counts_left), axis=-1) / np.maximum(n_left, 1)
+        gini_right = n_right - np.sum(np.square(counts_right), axis=-1) / np.maximum(n_right, 1)
+        return (gini_left + gini_right) / (n_left + n_right)
+
+
+    def compute_gini_scores_cumulative(self, stats):
+        # Compute the weighted Gini score of the splits stats[:i+1] / stats[i+1:] for all positions i at once
+        # (for a stack of histograms, i.e., one per feature, this is done for all features at once)
+        counts_left = np.cumsum(stats, axis=-2)
+        return self.compute_gini_scores_counts(counts_left, counts_left[...,-1:,:] - counts_left)
     
     
     def compute_partitions(self, feature_values):
@@ -94,10 +150,45 @@ class SeleneCART:
         return (values_sorted[:-1] + values_sorted[1:]) / 2.0    
 
 
+    def compute_bin_thresholds(self, feature_values):
+        # Get unique values; if there are not too many, the bins are exactly the unique values
+        values_sorted = np.unique(feature_values)
+        if len(values_sorted) <= self.max_bins:
+            return (values_sorted[:-1] + values_sorted[1:]) / 2.0
+        # Otherwise, use quantiles as bin boundaries so that all bins contain roughly the same number of samples
+        return np.unique(np.quantile(feature_values, np.linspace(0, 1, self.max_bins+1)[1:-1]))
+
+
+    def bin_features(self, X):
+        # Quantize each non-nominal feature into at most max_bins (<= 256) bins; nominal features remain all 0
+        self.bin_thresholds = [ None ] * X.shape[1]
+        X_binned = np.zeros(X.shape, dtype=np.uint8)
+        for col in range(X.shape[1]):
+            if self.feature_types[col] != "nominal":
+                x = X[:,col].astype(float)
+                self.bin_thresholds[col] = self.compute_bin_thresholds(x)
+                X_binned[:,col] = np.searchsorted(self.bin_thresholds[col], x, side="left")
+        self.binned_cols = np.flatnonzero([ thresholds is not None for thresholds in self.bin_thresholds ])
+        return X_binned
+
+
+    def compute_histograms(self, X_binned, indices, stats):
+        # Sum up the class counts of all samples (given by their indices) in the same bin, separately for each non-nominal feature;
+        # offsetting the bins of each feature allows counting all features in one bincount call per class
+        stats = stats[indices]
+        cols = self.binned_cols
+        bins = (X_binned[np.ix_(indices, cols)] + np.arange(len(cols)) * self.max_bins).ravel()
+        hist = np.zeros((X_binned.shape[1], self.max_bins, stats.shape[1]))
+        for c in range(stats.shape[1]):
+            hist[cols,:,c] = np.bincount(bins, weights=np.repeat(stats[:,c], len(cols)), minlength=len(cols)*self.max_bins).reshape(len(cols), self.max_bins)
+        return hist
+
+
     def generate_split_nominal(self, feature_values, partition):
-        indices_left  = [ idx  for idx, val in enumerate(feature_values) if val in partition[0] ]
-        indices_right = [ idx  for idx, val in enumerate(feature_values) if val in partition[1] ]
-        return indices_left, indices_right    
+        # Check the membership in the left partition only once for each unique value
+        values, inverse = np.unique(feature_values, return_inverse=True)
+        go_left = np.array([ val in partition[0] for val in values ], dtype=bool)[inverse.reshape(-1)]
+        return np.where(go_left)[0], np.where(~go_left)[0]    
 
     def generate_split_general(self, feature_values, threshold):
         # Get all row indices where the value is <= threshold
@@ -111,13 +202,12 @@ class SeleneCART:
         ## Initialize the return values
         best_score, best_criterion, best_split = np.inf, None, None
     
-        # Create splits depending on the feature being nominal or nonnominal
+        # Nominal features are handled based on the class counts of their categories
         if feature_type == "nominal":
-            criterions = self.compute_partitions(x)
-            generate_split = self.generate_split_nominal
-        else:
-            criterions = self.compute_thresholds(x)
-            generate_split = self.generate_split_general
+            return self.find_best_feature_split_nominal(x, y)
+        # Create splits for nonnominal features
+        criterions = self.compute_thresholds(x)
+        generate_split = self.generate_split_general
     
         # Check all thresholds/partitions to find the one yielding the lowest Gini score
         for criterion in criterions:
@@ -133,75 +223,232 @@ class SeleneCART:
     
         # Return key information of best split
         return best_score, best_criterion, best_split
+
+
+    def find_best_feature_split_nominal(self, x, y):
+        # Count the classes for each category (i.e., unique value) of the feature
+        categories, inverse = np.unique(x, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        if len(categories) < 2:
+            return np.inf, None, None
+        n_classes = len(self.classes)
+        codes = np.searchsorted(self.classes, y)
+        counts = np.bincount(inverse*n_classes + codes, minlength=len(categories)*n_classes).reshape(len(categories), n_classes)
+        n_node_classes = np.count_nonzero(np.sum(counts, axis=0))
+        if n_node_classes <= 2 or len(categories) > self.max_exhaustive_categories:
+            # Sort categories by the proportion of the most frequent class and consider only splits between consecutive categories;
+            # for 2 classes this is guaranteed to include the best partition (Breiman et al., 1984), otherwise it is a heuristic
+            # to avoid checking all 2^(k-1)-1 partitions
+            main_class = np.argmax(np.sum(counts, axis=0))
+            order = np.argsort(counts[:,main_class] / np.sum(counts, axis=1), kind="stable")
+            scores = self.compute_gini_scores_cumulative(counts[order])[:-1]
+            best = np.argmin(scores)
+            left = order[:best+1]
+        else:
+            # For few categories, check all partitions at once using a membership matrix (partition x category)
+            partitions = self.compute_partitions(range(len(categories)))
+            memberships = np.zeros((len(partitions), len(categories)))
+            for pidx, partition in enumerate(partitions):
+                memberships[pidx, list(partition[0])] = 1
+            counts_left = memberships @ counts
+            scores = self.compute_gini_scores_counts(counts_left, np.sum(counts, axis=0) - counts_left)
+            best = np.argmin(scores)
+            left = np.flatnonzero(memberships[best])
+        # Convert the best split into a partition of the feature values and the corresponding indices
+        go_left = np.zeros(len(categories), dtype=bool)
+        go_left[left] = True
+        partition = (set(categories[go_left]), set(categories[~go_left]))
+        split = (np.where(go_left[inverse])[0], np.where(~go_left[inverse])[0])
+        # Return key information of best split
+        return scores[best], partition, split
+
+
+    def find_best_feature_splits_histogram(self, hist):
+        # Splitting after bin b puts all samples with a bin <= b into the left child; only splits between two non-empty
+        # bins need to be considered, i.e., after each non-empty bin except the last one (the same for all features at once)
+        nonempty = np.sum(hist, axis=2) > 0
+        valid = nonempty & (np.cumsum(nonempty[:,::-1], axis=1)[:,::-1] > 1)
+        # Compute the Gini scores of all splits at once from the cumulative histograms and pick the one with the lowest score per feature
+        scores = np.where(valid, self.compute_gini_scores_cumulative(hist), np.inf)
+        positions = np.argmin(scores, axis=1)
+        # Return the best score and the bin after which to split for each feature (the score is inf if there is no valid split)
+        return scores[np.arange(len(scores)),positions], positions
     
     
-    def find_best_split(self, X, y):
+    def find_best_split(self, X, y, indices, X_binned=None, hist=None):
         # Initialize the return values
         best_score, best_criterion, best_col, best_split = np.inf, None, None, None
+        # In binned mode, find the best splits of all binned features at once from their histograms
+        if hist is not None:
+            hist_scores, hist_positions = np.full(X.shape[1], np.inf), np.zeros(X.shape[1], dtype=int)
+            hist_scores[self.binned_cols], hist_positions[self.binned_cols] = self.find_best_feature_splits_histogram(hist[self.binned_cols])
         # Check for each feature (i.e., each column in X), which split has the best (lowest) score
         for col in range(X.shape[1]):
-            # Extract feature values from datasets
-            x = X[:,col]
-            # Calculate the best split for the current column/feature
-            score, threshold, split = self.find_best_feature_split(x, y, self.feature_types[col])
+            # Calculate the best split for the current column/feature (using the histograms for binned features);
+            # the split of a binned feature is only generated once the best feature is known (see below)
+            if hist is not None and self.bin_thresholds[col] is not None:
+                score, split = hist_scores[col], None
+                # The threshold is the upper boundary of the bin
+                threshold = self.bin_thresholds[col][hist_positions[col]] if score < np.inf else None
+            else:
+                score, threshold, split = self.find_best_feature_split(X[indices,col], y, self.feature_types[col])
             # Keep track of the key information of the split with the lowest Gini score
             if score <= best_score:
                 best_score, best_split, best_col, best_threshold = score, split, col, threshold
+        # Generate the split of the best feature if it is a binned feature
+        if best_split is None and best_threshold is not None:
+            best_split = self.generate_split_general(X_binned[indices,best_col], hist_positions[best_col])
         # Return the best split together with the relevant information
         return best_score, best_threshold, best_col, best_split
     
     
     
     def fit(self, X, y):
-        # Initializa Decision Tree as a single root node
-        self.tree = Node(y)
+        # Initializa Decision Tree as a single root node; all nodes refer to their samples using views into
+        # the same index array which gets partitioned in place with each split (i.e., X and y are never copied)
+        self.tree = Node(np.arange(len(y)), y)
+        self.classes = np.unique(y)
+        self.category_codes = [ { v: code for code, v in enumerate(np.unique(X[:,col])) } if self.feature_types[col] == "nominal" else None for col in range(X.shape[1]) ]
+        # In binned mode, quantize the non-nominal features and compute the per-bin class counts of the root node
+        X_binned, stats, hist = None, None, None
+        if self.max_bins is not None:
+            stats = self.compute_gini_stats(y)
+            X_binned = self.bin_features(X)
+            hist = self.compute_histograms(X_binned, self.tree.indices, stats)
         # Start recursive building of Decision Tree
-        self._fit(X, y, self.tree)
+        self._fit(X, y, self.tree, X_binned, stats, hist)
+        # Convert the tree into its flattened representation for fast prediction
+        self.compile_tree()
         # Return Decision Tree object
         return self
 
 
-    def _fit(self, X, y, node, depth=0):
-        # Calculate and set Gini score of the node itself
-        node.score = self.compute_gini_score_node(y) 
+    def _fit(self, X, y, node, X_binned=None, stats=None, hist=None, depth=0):
+        # Get the labels of all samples assigned to the node
+        indices = node.indices
+        y_node = y[indices]
+        # Calculate and set Gini score and class counts of the node itself
+        node.score = self.compute_gini_score_node(y_node) 
+        node.value = self.compute_node_value(y_node)
         ### Check stop criteria ###############################################################
         # Stop splitting if we reach the max_depth
         if self.max_depth is not None and depth >= self.max_depth:
             return    
         # Stop splitting if the node has less then min_samples_split samples
-        if self.min_samples_split is not None and self.min_samples_split >= len(node.y):
+        if self.min_samples_split is not None and self.min_samples_split >= len(indices):
             return        
         # If all class labels are the same, no need for any further splitting
-        if len(np.unique(y)) == 1:
+        if len(np.unique(y_node)) == 1:
             return
         #########################################################################################
         # Calculate the best split
-        score, criterion, col, split = self.find_best_split(X, y)
+        score, criterion, col, split = self.find_best_split(X, y_node, indices, X_binned, hist)
         # If the information gain is negative, no need for further splitting
         if score > node.score:
             return
-        # Split the input and labels using the indices from the split
-        X_left, X_right = X[split[0]], X[split[1]]
-        y_left, y_right = y[split[0]], y[split[1]]
+        # Partition the indices of the node in place: the first n_left indices now belong to the left child
+        n_left = len(split[0])
+        indices[:n_left], indices[n_left:] = indices[split[0]], indices[split[1]]
+        indices_left, indices_right = indices[:n_left], indices[n_left:]
+        # In binned mode, only build the histograms of the smaller child; the other ones are the difference to the parent's
+        hist_left, hist_right = None, None
+        if hist is not None:
+            if len(indices_left) <= len(indices_right):
+                hist_left = self.compute_histograms(X_binned, indices_left, stats)
+                hist_right = hist - hist_left
+            else:
+                hist_right = self.compute_histograms(X_binned, indices_right, stats)
+                hist_left = hist - hist_right
         # Update the parent node based on the best split
         node.feature_col = col
         node.criterion = criterion
-        node.left_child = Node(y_left)
-        node.right_child = Node(y_right)
+        node.left_child = Node(indices_left, y)
+        node.right_child = Node(indices_right, y)
         # Recursively fit both child nodes (left and right)
-        self._fit(X_left, y_left, node.left_child, depth=depth+1)
-        self._fit(X_right, y_right, node.right_child, depth=depth+1)   
+        self._fit(X, y, node.left_child, X_binned, stats, hist_left, depth=depth+1)
+        self._fit(X, y, node.right_child, X_binned, stats, hist_right, depth=depth+1)   
 
 
 
     
+    def compile_tree(self):
+        # Collect all nodes in depth-first order so that each node gets a unique id (the root gets id 0)
+        nodes, stack = [], [self.tree]
+        while len(stack) > 0:
+            node = stack.pop()
+            nodes.append(node)
+            if not node.is_leaf():
+                stack.extend([node.right_child, node.left_child])
+        node_ids = { id(node): nid for nid, node in enumerate(nodes) }
+        # Store all nodes as parallel arrays; leaves are marked by a feature column of -1
+        self.feature_cols = np.array([ -1 if node.is_leaf() else node.feature_col for node in nodes ], dtype=np.int64)
+        self.left_children = np.array([ -1 if node.is_leaf() else node_ids[id(node.left_child)] for node in nodes ], dtype=np.int64)
+        self.right_children = np.array([ -1 if node.is_leaf() else node_ids[id(node.right_child)] for node in nodes ], dtype=np.int64)
+        self.values = np.array([ node.value for node in nodes ])
+        # Thresholds are only set for non-nominal splits; nominal splits are represented as lookup tables over all category codes
+        # (the last column remains False so unknown categories with code -1 always go into the right child)
+        n_categories = max([ len(codes) for codes in self.category_codes if codes is not None ], default=0)
+        self.thresholds = np.full(len(nodes), np.nan)
+        self.left_masks = np.zeros((len(nodes), n_categories+1), dtype=bool)
+        for nid, node in enumerate(nodes):
+            if node.is_leaf():
+                continue
+            if self.feature_types[node.feature_col] == "nominal":
+                self.left_masks[nid, [ self.category_codes[node.feature_col][v] for v in node.criterion[0] ]] = True
+            else:
+                self.thresholds[nid] = node.criterion
+
+
     ###############################################################################################
     ### Prediction
     ###############################################################################################
+
+    def encode_features(self, X):
+        # Convert all features into a numerical matrix; nominal values are replaced by their category codes (-1 if unknown)
+        X_encoded = np.empty(X.shape, dtype=np.float64)
+        for col in range(X.shape[1]):
+            if self.feature_types[col] == "nominal":
+                values, inverse = np.unique(X[:,col], return_inverse=True)
+                codes = np.array([ self.category_codes[col].get(v, -1) for v in values ])
+                X_encoded[:,col] = codes[inverse.reshape(-1)]
+            else:
+                X_encoded[:,col] = X[:,col].astype(float)
+        return X_encoded
+
+
+    def get_leaf_ids(self, X):
+        # Keep the original types of all values (e.g., if X is a list of mixed numbers and strings)
+        if not isinstance(X, np.ndarray):
+            X = np.array(X, dtype=object)
+        X = self.encode_features(X)
+        is_nominal = np.array([ t == "nominal" for t in self.feature_types ])
+        # Start with all samples in the root node
+        leaf_ids = np.zeros(len(X), dtype=np.int64)
+        active = np.flatnonzero(self.feature_cols[leaf_ids] >= 0)
+        # Move all samples not yet in a leaf one level down the tree at a time
+        while len(active) > 0:
+            node_ids = leaf_ids[active]
+            cols = self.feature_cols[node_ids]
+            x = X[active, cols]
+            # Check the lookup table for nominal features, and the threshold for all other features
+            codes = np.where(is_nominal[cols], x, -1).astype(np.int64)
+            go_left = np.where(is_nominal[cols], self.left_masks[node_ids, codes], x <= self.thresholds[node_ids])
+            leaf_ids[active] = np.where(go_left, self.left_children[node_ids], self.right_children[node_ids])
+            active = active[self.feature_cols[leaf_ids[active]] >= 0]
+        # Return the id of the leaf for each sample
+        return leaf_ids
+
+
+    def predict(self, X, chunk_size: int=100_000):
+        return predict_in_chunks(self.predict_batch, X, chunk_size=chunk_size)
+
         
-    def predict(self, X):
-        # Return list of individually predicted labels
-        return np.array([ self.predict_sample(self.tree, x) for x in X ])
+    def predict_batch(self, X):
+        # Get the class counts of the leaf of each sample
+        counts = self.values[self.get_leaf_ids(X)]
+        # Return the class with highest probability for each sample
+        # (this can happen of in the leaf are still different classes)
+        return self.classes[np.argmax(counts, axis=1)]
 
 
     def predict_sample(self, node, x):
@@ -241,4 +488,49 @@ class SeleneCART:
             self.print_tree(node.left_child, level=level+1)
         if node.right_child is not None:
             self.print_tree(node.right_child, level=level+1)
-        
\ No newline at end of file
+        
+
+
+    ###############################################################################################
+    ### Saving & Loading
+    ###############################################################################################
+
+    def get_params(self):
+        return { "feature_types": list(self.feature_types), "max_depth": self.max_depth, "min_samples_split": self.min_samples_split,
+                 "max_bins": self.max_bins, "max_exhaustive_categories": self.max_exhaustive_categories }
+
+
+    def get_arrays(self):
+        # Only the flattened representation is required for prediction (i.e., the Node objects are not saved)
+        return { "feature_cols": self.feature_cols, "thresholds": self.thresholds, "left_children": self.left_children,
+                 "right_children": self.right_children, "values": self.values, "left_masks": self.left_masks, "classes": self.classes }
+
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        arrays = self.get_arrays()
+        # The known categories of nominal features are saved in the order of their codes
+        categories = [ None if codes is None else [ v.item() if isinstance(v, np.generic) else v for v in codes ] for codes in self.category_codes ]
+        config = { "format_version": self.FORMAT_VERSION, "params": self.get_params(), "categories": categories, "arrays": list(arrays.keys()) }
+        with open(os.path.join(path, "model.json"), "w") as f:
+            json.dump(config, f)
+        for name, array in arrays.items():
+            # Object arrays (e.g., string labels) would require pickle, so they are converted to a native dtype first
+            if array.dtype == object:
+                array = np.array(array.tolist())
+            np.save(os.path.join(path, f"{name}.npy"), array)
+        return path
+
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        with open(os.path.join(path, "model.json")) as f:
+            config = json.load(f)
+        if config["format_version"] != cls.FORMAT_VERSION:
+            raise ValueError(f"Unsupported format version: {config['format_version']}")
+        # Only the flattened tree is restored (all arrays are memory-mapped by default); the Node objects are not available
+        model = cls(**config["params"])
+        model.category_codes = [ None if values is None else { v: code for code, v in enumerate(values) } for values in config["categories"] ]
+        for name in config["arrays"]:
+            setattr(model, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode))
+        return model
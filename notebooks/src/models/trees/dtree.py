@@ -1,21 +1,51 @@
+import os
+import json
+import heapq
 import numpy as np
+from collections.abc import Iterator
 
 
 
 
+def predict_in_chunks(predict_batch, X, chunk_size: int=100_000):
+    # For an iterator of chunks (e.g., reading a large file piece by piece), yield the predictions chunk by chunk
+    if isinstance(X, Iterator):
+        return ( predict_batch(chunk) for chunk in X )
+    # Arrays (incl. memory-mapped arrays) are processed in chunks so that only one chunk is loaded at a time
+    if len(X) <= chunk_size:
+        return predict_batch(X)
+    return np.concatenate([ predict_batch(X[start:start+chunk_size]) for start in range(0, len(X), chunk_size) ])
+
+
+
 class Node():
     """
     Implements an individual node in the Decision Tree. 
     """      
     
-    def __init__(self, y):
-        self.y = y                 # Labels of sample assigned to that node
+    def __init__(self, samples, start, end, targets):
+        self.samples = samples     # Index array shared by all nodes; the samples of this node are samples[start:end]
+        self.start = start         # First position of the node's samples in the shared index array
+        self.end = end             # Position after the last sample of the node in the shared index array
+        self.targets = targets     # Targets of all training samples (shared by all nodes)
+        self.value = None          # Summary statistics of the node (e.g., class counts or mean)
         self.score = np.inf        # Score of the node (measure of impurity)
+        self.n_samples = 0         # (Weighted) number of samples assigned to the node
         self.feature_idx = None    # The feature used for the split (column number)
         self.threshold = None      # Threshold used of the splot (scalar value)
         self.left_child = None     # Left child of the node (of type Node)
         self.right_child = None    # Right child of the node (of type Node)
         
+    @property
+    def indices(self):
+        # Indices of samples assigned to that node (view into the shared index array)
+        return self.samples[self.start:self.end]
+
+    @property
+    def y(self):
+        # Labels of samples assigned to that node (only extracted when needed)
+        return self.targets[np.sort(self.indices)]
+
     def is_leaf(self):
         if self.feature_idx is None:
             return True
@@ -33,7 +63,10 @@ class Node():
 
 class SeleneDecisionTree:
 
-    def __init__(self, max_depth: int=None, min_samples_split: int=2, max_features: int=None):        
+    FORMAT_VERSION = 1
+
+    def __init__(self, max_depth: int=None, min_samples_split: int=2, max_features: int=None, max_bins: int=None,
+                 min_impurity_decrease: float=0.0, max_leaf_nodes: int=None, ccp_alpha: float=0.0, random_state: int=None):
         # Just a check if the parameter values are meaningful
         if max_depth is not None and max_depth < 1:
             raise Exception('If specified, max_depth must be greater or equal to 0')
@@ -41,11 +74,28 @@ class SeleneDecisionTree:
             raise Exception('If specified, min_samples_split must be greater or equal to 0')
         if max_features is not None and max_features < 1:
             raise Exception('If specified, max_features must be greater or equal to 1')
+        if max_bins is not None and (max_bins < 2 or max_bins > 256):
+            raise Exception('If specified, max_bins must be between 2 and 256')
+        if min_impurity_decrease < 0:
+            raise Exception('min_impurity_decrease must be greater or equal to 0')
+        if max_leaf_nodes is not None and max_leaf_nodes < 2:
+            raise Exception('If specified, max_leaf_nodes must be greater or equal to 2')
+        if ccp_alpha < 0:
+            raise Exception('ccp_alpha must be greater or equal to 0')
             
         self.tree = None
+        # Flattened representation of the tree as parallel arrays (index = node id, root = 0)
+        self.feature_idxs, self.thresholds, self.left_children, self.right_children, self.values = None, None, None, None, None
         self.max_depth = max_depth
         self.min_samples_split = min_samples_split
         self.max_features = max_features
+        self.max_bins = max_bins
+        self.min_impurity_decrease = min_impurity_decrease
+        self.max_leaf_nodes = max_leaf_nodes
+        self.ccp_alpha = ccp_alpha
+        self.bin_thresholds = None
+        self.random_state = random_state
+        self.rng = None
 
     def compute_thresholds(self, feature_values):
         # Get unique values to handle duplicates; return values will already be sorted
@@ -61,11 +111,39 @@ class SeleneDecisionTree:
         # Return indices
         return indices_left, indices_right      
 
+    def compute_bin_thresholds(self, feature_values):
+        # Get unique values; if there are not too many, the bins are exactly the unique values
+        values_sorted = np.unique(feature_values)
+        if len(values_sorted) <= self.max_bins:
+            return (values_sorted[:-1] + values_sorted[1:]) / 2.0
+        # Otherwise, use quantiles as bin boundaries so that all bins contain roughly the same number of samples
+        return np.unique(np.quantile(feature_values, np.linspace(0, 1, self.max_bins+1)[1:-1]))
+
+    def bin_features(self, X):
+        # Quantize each feature into at most max_bins (<= 256) bins; bin b contains all values in (thresholds[b-1], thresholds[b]]
+        self.bin_thresholds = [ self.compute_bin_thresholds(X[:,fidx]) for fidx in range(X.shape[1]) ]
+        X_binned = np.empty(X.shape, dtype=np.uint8)
+        for fidx, thresholds in enumerate(self.bin_thresholds):
+            X_binned[:,fidx] = np.searchsorted(thresholds, X[:,fidx], side="left")
+        return X_binned
+
+    def compute_histograms(self, X_binned, indices, stats, feature_indices=None):
+        # Sum up the statistics of all samples (given by their indices) in the same bin, separately for each feature (or only
+        # for the given features); offsetting the bins of each feature allows counting all features in one bincount call per statistic
+        stats = stats[indices]
+        X_binned = X_binned[indices] if feature_indices is None else X_binned[np.ix_(indices, feature_indices)]
+        n_features = X_binned.shape[1]
+        bins = (X_binned + np.arange(n_features) * self.max_bins).ravel()
+        hist = np.empty((n_features, self.max_bins, stats.shape[1]))
+        for col in range(stats.shape[1]):
+            hist[:,:,col] = np.bincount(bins, weights=np.repeat(stats[:,col], n_features), minlength=n_features*self.max_bins).reshape(n_features, self.max_bins)
+        return hist
+
     def sample_feature_indices(self, X):
         n_features = X.shape[1]
         if self.max_features is not None:
             n_features = min(n_features, self.max_features)
-        return np.random.choice(np.arange(X.shape[1]), size=n_features, replace=False)
+        return self.rng.choice(np.arange(X.shape[1]), size=n_features, replace=False)
     
     def find_best_feature_split(self, x, y, split_scoring_func):
         # Initialize the return values
@@ -85,66 +163,286 @@ class SeleneDecisionTree:
                 best_score, best_threshold, best_split = score, threshold, split
         # Return key information of best split
         return best_score, best_threshold, best_split
+
+    def find_best_feature_split_sorted(self, x, stats, prefix_scoring_func):
+        # Sort the feature values only once; splitting at position i puts the first i+1 samples into the left child
+        order = np.argsort(x, kind="stable")
+        x_sorted = x[order]
+        # Only positions between two different values are valid splits
+        positions = np.flatnonzero(x_sorted[:-1] < x_sorted[1:])
+        if len(positions) == 0:
+            return np.inf, None, None
+        # Compute the scores of all splits at once from cumulative statistics and pick the one with the lowest score
+        scores = prefix_scoring_func(stats[order])[positions]
+        best = np.argmin(scores)
+        best_threshold = (x_sorted[positions[best]] + x_sorted[positions[best]+1]) / 2.0
+        # Return key information of best split (the split itself is only generated for the best feature)
+        return scores[best], best_threshold, None
+
+    def find_best_feature_splits_histogram(self, hist, prefix_scoring_func):
+        # Evaluate the splits of several features at once given their histograms (one per feature); splitting after bin b
+        # puts all samples with a bin <= b into the left child, and is only valid if bin b and any later bin are non-empty
+        # (the sum of all statistics of a bin is positive if it is not empty; the tolerance accounts for rounding errors in
+        # histograms computed as the difference of two histograms)
+        weights = np.sum(hist, axis=2)
+        nonempty = weights > 1e-12 * np.sum(weights, axis=1, keepdims=True)
+        valid = nonempty & (np.cumsum(nonempty[:,::-1], axis=1)[:,::-1] > 1)
+        # Compute the scores of all splits of all features from the cumulative histograms and pick the best one for each feature
+        scores = np.where(valid, prefix_scoring_func(hist), np.inf)
+        positions = np.argmin(scores, axis=1)
+        # Return the lowest score and the corresponding threshold (here, the bin index) for each feature
+        return scores[np.arange(len(scores)),positions], positions
     
-    def find_best_split(self, X, y, split_scoring_func):
+    def find_best_split(self, X, y, indices, split_scoring_func, prefix_scoring_func=None, stats=None, hist=None):
         # Initialize the return values
         best_score, best_threshold, best_fidx, best_split = np.inf, None, None, None
         # Perform feature sampling
         sampled_feature_indices = self.sample_feature_indices(X)
+        # In binned mode, evaluate the splits of all sampled features at once using their histograms; without histograms
+        # of the node, only the histograms of the sampled features are built (but only if the node has more samples than bins,
+        # otherwise sorting the bin indices of the samples is cheaper)
+        binned = self.max_bins is not None and stats is not None
+        if binned and (len(indices) >= self.max_bins or hist is not None):
+            if hist is None:
+                hist = self.compute_histograms(X, indices, stats, sampled_feature_indices)
+            else:
+                hist = hist[sampled_feature_indices]
+            scores, thresholds = self.find_best_feature_splits_histogram(hist, prefix_scoring_func)
+            # Pick the feature with the lowest score (the last one in case of ties, same as below)
+            best = len(scores) - 1 - np.argmin(scores[::-1])
+            if scores[best] == np.inf:
+                return np.inf, None, None, None
+            best_fidx = sampled_feature_indices[best]
+            return scores[best], thresholds[best], best_fidx, self.generate_split(X[indices,best_fidx], thresholds[best])
+        # Extract the statistics of the samples (given by their indices) only once for all features
+        if stats is not None:
+            stats = stats[indices]
         # Check for each feature (i.e., each column in X), which split has the best (lowest) score
         for fidx in sampled_feature_indices:
-            # Extract feature values from datasets
-            x = X[:,fidx]
-            # Calculate the best split for the current column/feature
-            score, threshold, split = self.find_best_feature_split(x, y, split_scoring_func)
+            # Calculate the best split for the current column/feature (evaluate all thresholds in one pass if possible)
+            if prefix_scoring_func is not None:
+                # Bin indices are uint8 values, which would overflow when computing the midpoint between two bins
+                x = X[indices,fidx].astype(np.int64) if binned else X[indices,fidx]
+                score, threshold, split = self.find_best_feature_split_sorted(x, stats, prefix_scoring_func)
+                # For bin indices, the threshold has to be the bin index of the last sample going into the left child
+                if binned and threshold is not None:
+                    threshold = np.max(x[x <= threshold])
+            else:
+                score, threshold, split = self.find_best_feature_split(X[indices,fidx], y, split_scoring_func)
             # Keep track of the key information of the split with the lowest score
             if score <= best_score:
                 best_score, best_split, best_fidx, best_threshold = score, split, fidx, threshold
+        # Generate the split only for the best feature (if not already done)
+        if best_split is None and best_threshold is not None:
+            best_split = self.generate_split(X[indices,best_fidx], best_threshold)
         # Return the best split together with the relevant information
         return best_score, best_threshold, best_fidx, best_split
     
-    def fit(self, X, y, node_scoring_func, split_scoring_func):
-        # Initialize Decision Tree as a single root node
-        self.tree = Node(y)
-        # Start recursive building of Decision Tree
-        self._fit(X, y, self.tree, node_scoring_func, split_scoring_func)
+    def fit(self, X, y, node_scoring_func, split_scoring_func, stats_func=None, prefix_scoring_func=None, sample_weight=None, bin_thresholds=None):
+        # Use NumPy's global random number generator (for feature sampling) if no random state is given
+        self.rng = np.random if self.random_state is None else np.random.RandomState(self.random_state)
+        # With integer sample weights (e.g., the bootstrap counts of a Random Forest), samples with a weight of 0 are ignored
+        # and all other samples count as often as their weight; this requires scoring splits from per-sample statistics
+        samples = np.arange(len(y))
+        if sample_weight is not None:
+            if stats_func is None or prefix_scoring_func is None:
+                raise Exception('Sample weights require functions to compute and score per-sample statistics')
+            sample_weight = np.asarray(sample_weight)
+            samples = np.flatnonzero(sample_weight > 0)
+        # Initialize Decision Tree as a single root node; all nodes refer to their samples as a range of
+        # the same index array which gets partitioned in place with each split (i.e., X and y are never copied)
+        self.tree = Node(samples, 0, len(samples), y)
+        # Compute the per-sample statistics (e.g., one-hot class vectors) required to score all splits in one pass
+        stats, hist = None, None
+        if stats_func is not None and prefix_scoring_func is not None:
+            stats = stats_func(y)
+            if sample_weight is not None:
+                stats = stats * sample_weight[:,np.newaxis]
+            # In binned mode, quantize the features (unless X has already been binned w.r.t. the given thresholds,
+            # e.g., once for all trees of a Random Forest) and compute the per-bin histograms of the root node
+            if self.max_bins is not None:
+                if bin_thresholds is None:
+                    X = self.bin_features(X)
+                else:
+                    self.bin_thresholds = bin_thresholds
+                # If only a few features are sampled at each split, building their histograms for both children is cheaper
+                # than building the histograms of all features for the smaller child (and subtracting them from the parent's)
+                if self.max_features is None or 2 * self.max_features >= X.shape[1]:
+                    hist = self.compute_histograms(X, self.tree.indices, stats)
+        # Build the Decision Tree, either recursively (depth-first) or best-first if the number of leaves is limited
+        if self.max_leaf_nodes is None:
+            self._fit(X, y, self.tree, node_scoring_func, split_scoring_func, prefix_scoring_func, stats, hist, sample_weight)
+        else:
+            self._fit_best_first(X, y, node_scoring_func, split_scoring_func, prefix_scoring_func, stats, hist, sample_weight)
+        # Post-hoc cost-complexity pruning (only requires the scores and sample counts cached in the nodes)
+        if self.ccp_alpha > 0:
+            self.prune_node(self.tree, self.ccp_alpha)
+        # Convert the tree into its flattened representation for fast prediction
+        self.compile_tree()
         # Return Decision Tree object
         return self
 
-    def _fit(self, X, y, node, node_scoring_func, split_scoring_func, depth=0):
-        # Calculate and set score of the node itself
-        node.score = node_scoring_func(y)
+    def _fit(self, X, y, node, node_scoring_func, split_scoring_func, prefix_scoring_func=None, stats=None, hist=None, sample_weight=None, depth=0):
+        # Find the best split of the node (if the node should be split at all)
+        candidate = self.evaluate_node(X, y, node, node_scoring_func, split_scoring_func, prefix_scoring_func, stats, hist, sample_weight, depth)
+        if candidate is None:
+            return
+        # Split the node and recursively fit both child nodes (left and right)
+        hist_left, hist_right = self.split_node(X, y, node, candidate, stats, hist)
+        self._fit(X, y, node.left_child, node_scoring_func, split_scoring_func, prefix_scoring_func, stats, hist_left, sample_weight, depth=depth+1)
+        self._fit(X, y, node.right_child, node_scoring_func, split_scoring_func, prefix_scoring_func, stats, hist_right, sample_weight, depth=depth+1)
+
+    def _fit_best_first(self, X, y, node_scoring_func, split_scoring_func, prefix_scoring_func=None, stats=None, hist=None, sample_weight=None):
+        # Priority queue of all leaves that can be split, ordered by the impurity decrease of their best split (largest first);
+        # the counter breaks ties in the order the leaves were added (and avoids comparing Node objects). Each entry only
+        # keeps the feature and threshold of the best split, but neither the split itself nor the histograms of the leaf,
+        # so that the memory does not grow with the number of leaves
+        heap, counter, n_leaves = [], 0, 1
+        candidate = self.evaluate_node(X, y, self.tree, node_scoring_func, split_scoring_func, prefix_scoring_func, stats, hist, sample_weight, 0)
+        if candidate is not None:
+            heapq.heappush(heap, (-candidate[0], counter, self.tree, candidate[1], candidate[2], 0))
+        # Always split the leaf with the largest impurity decrease until the maximum number of leaves is reached
+        while len(heap) > 0 and n_leaves < self.max_leaf_nodes:
+            neg_impurity_decrease, _, node, threshold, idx, depth = heapq.heappop(heap)
+            # The split is generated again from the feature and threshold (no histograms needed for the children, see below)
+            self.split_node(X, y, node, (-neg_impurity_decrease, threshold, idx, None), stats)
+            n_leaves += 1
+            for child in [node.left_child, node.right_child]:
+                # In binned mode, the histograms of both children are built only to find their best splits (together this
+                # is as costly as rebuilding the histograms of the split node and subtracting the ones of the smaller child)
+                hist_child = self.compute_histograms(X, child.indices, stats) if hist is not None else None
+                candidate = self.evaluate_node(X, y, child, node_scoring_func, split_scoring_func, prefix_scoring_func, stats, hist_child, sample_weight, depth+1)
+                if candidate is not None:
+                    counter += 1
+                    heapq.heappush(heap, (-candidate[0], counter, child, candidate[1], candidate[2], depth+1))
+
+    def evaluate_node(self, X, y, node, node_scoring_func, split_scoring_func, prefix_scoring_func=None, stats=None, hist=None, sample_weight=None, depth=0):
+        # Get the targets of all samples assigned to the node
+        indices = node.indices
+        y_node = y[indices]
+        # Calculate and set score, summary statistics and (weighted) number of samples of the node itself
+        if sample_weight is None:
+            node.score = node_scoring_func(y_node)
+            node.value = self.compute_node_value(y_node)
+            node.n_samples = len(indices)
+        else:
+            # The weighted score is the score of a "split" with all samples in the left child
+            node.score = prefix_scoring_func(np.sum(stats[indices], axis=0, keepdims=True))[0]
+            node.value = self.compute_node_value(y_node, sample_weight[indices])
+            node.n_samples = np.sum(sample_weight[indices])
         ### Check stop criteria ###############################################################
         # Stop splitting if we reach the max_depth
         if self.max_depth is not None and depth >= self.max_depth:
-            return          
+            return None
         # Stop splitting if the node has less then min_samples_split samples
-        if self.min_samples_split is not None and self.min_samples_split > len(node.y):
-            return        
+        if self.min_samples_split is not None and self.min_samples_split > node.n_samples:
+            return None
         # If all targets are the same, no need for any further splitting
-        if len(np.unique(y)) == 1:
-            return
+        if len(np.unique(y_node)) == 1:
+            return None
         #########################################################################################
         # Calculate the best split
-        score, threshold, idx, split = self.find_best_split(X, y, split_scoring_func)
+        score, threshold, idx, split = self.find_best_split(X, y_node, indices, split_scoring_func, prefix_scoring_func, stats, hist)
         # If the information gain is negative, no need for further splitting
         if score > node.score:
-            return
-        # Split the input and labels using the indices from the split
-        X_left, X_right = X[split[0]], X[split[1]]
-        y_left, y_right = y[split[0]], y[split[1]]
+            return None
+        # Stop splitting if the decrease of the impurity (weighted by the fraction of all samples in the node) is too small
+        impurity_decrease = node.n_samples / self.tree.n_samples * (node.score - score)
+        if impurity_decrease < self.min_impurity_decrease:
+            return None
+        # Return the key information of the best split
+        return impurity_decrease, threshold, idx, split
+
+    def split_node(self, X, y, node, candidate, stats=None, hist=None):
+        _, threshold, idx, split = candidate
+        # Partition the indices of the node in place: the first n_left indices now belong to the left child
+        indices = node.indices
+        if split is None:
+            split = self.generate_split(X[indices,idx], threshold)
+        n_left = len(split[0])
+        indices[:n_left], indices[n_left:] = indices[split[0]], indices[split[1]]
+        indices_left, indices_right = indices[:n_left], indices[n_left:]
+        # In binned mode, only build the histograms of the smaller child; the other ones are the difference to the parent's
+        hist_left, hist_right = None, None
+        if hist is not None:
+            if len(indices_left) <= len(indices_right):
+                hist_left = self.compute_histograms(X, indices_left, stats)
+                hist_right = hist - hist_left
+            else:
+                hist_right = self.compute_histograms(X, indices_right, stats)
+                hist_left = hist - hist_right
+        # In binned mode, convert bin index back to the original feature value (required for the prediction)
+        if self.max_bins is not None and stats is not None:
+            threshold = self.bin_thresholds[idx][threshold]
         # Update the parent node based on the best split
         node.feature_idx = idx
         node.threshold = threshold
-        node.left_child = Node(y_left)
-        node.right_child = Node(y_right)
-        # Recursively fit both child nodes (left and right)
-        self._fit(X_left, y_left, node.left_child, node_scoring_func, split_scoring_func, depth=depth+1)
-        self._fit(X_right, y_right, node.right_child, node_scoring_func, split_scoring_func, depth=depth+1)   
+        node.left_child = Node(node.samples, node.start, node.start+n_left, y)
+        node.right_child = Node(node.samples, node.start+n_left, node.end, y)
+        # Return the histograms of both child nodes (None if not in binned mode)
+        return hist_left, hist_right
+
+    def prune_node(self, node, ccp_alpha):
+        # The cost of a node as a leaf is its impurity weighted by the fraction of all samples in the node, plus ccp_alpha
+        leaf_cost = node.n_samples / self.tree.n_samples * node.score + ccp_alpha
+        if node.is_leaf():
+            return leaf_cost
+        # Prune the subtrees of both children first (bottom-up); this yields the cost of the best subtree rooted at this node
+        subtree_cost = self.prune_node(node.left_child, ccp_alpha) + self.prune_node(node.right_child, ccp_alpha)
+        # Turn the node into a leaf if its subtree does not pay off (this yields the same tree as weakest-link pruning)
+        if leaf_cost <= subtree_cost:
+            node.feature_idx, node.threshold, node.left_child, node.right_child = None, None, None, None
+            return leaf_cost
+        return subtree_cost
+
+    def prune(self, ccp_alpha: float):
+        # Pruning requires the Node objects, which are not available for a loaded model
+        if self.tree is None:
+            raise Exception('Pruning requires a fitted tree (a loaded model cannot be pruned)')
+        if ccp_alpha < 0:
+            raise Exception('ccp_alpha must be greater or equal to 0')
+        self.ccp_alpha = ccp_alpha
+        self.prune_node(self.tree, ccp_alpha)
+        # The flattened representation has to reflect the pruned tree
+        self.compile_tree()
+        return self
     
+    def compile_tree(self):
+        # Collect all nodes in depth-first order so that each node gets a unique id (the root gets id 0)
+        nodes, stack = [], [self.tree]
+        while len(stack) > 0:
+            node = stack.pop()
+            nodes.append(node)
+            if not node.is_leaf():
+                stack.extend([node.right_child, node.left_child])
+        node_ids = { id(node): nid for nid, node in enumerate(nodes) }
+        # Store all nodes as parallel arrays; leaves are marked by a feature index of -1
+        self.feature_idxs = np.array([ -1 if node.is_leaf() else node.feature_idx for node in nodes ], dtype=np.int64)
+        self.thresholds = np.array([ np.nan if node.is_leaf() else node.threshold for node in nodes ], dtype=np.float64)
+        self.left_children = np.array([ -1 if node.is_leaf() else node_ids[id(node.left_child)] for node in nodes ], dtype=np.int64)
+        self.right_children = np.array([ -1 if node.is_leaf() else node_ids[id(node.right_child)] for node in nodes ], dtype=np.int64)
+        self.values = np.array([ node.value for node in nodes ])
+
     ###############################################################################################
     ### Prediction
     ###############################################################################################
+
+    def get_leaf_ids(self, X):
+        # Start with all samples in the root node
+        X = np.asarray(X)
+        leaf_ids = np.zeros(len(X), dtype=np.int64)
+        active = np.flatnonzero(self.feature_idxs[leaf_ids] >= 0)
+        # Move all samples not yet in a leaf one level down the tree at a time
+        while len(active) > 0:
+            node_ids = leaf_ids[active]
+            go_left = X[active, self.feature_idxs[node_ids]] <= self.thresholds[node_ids]
+            leaf_ids[active] = np.where(go_left, self.left_children[node_ids], self.right_children[node_ids])
+            active = active[self.feature_idxs[leaf_ids[active]] >= 0]
+        # Return the id of the leaf for each sample
+        return leaf_ids
+        
+    def predict(self, X, chunk_size: int=100_000):
+        return predict_in_chunks(self.predict_batch, X, chunk_size=chunk_size)
         
     def get_targets(self, X):
         # Return list of individually predicted labels
@@ -180,11 +478,59 @@ class SeleneDecisionTree:
             self.print_tree(node.right_child, level=level+1)
 
 
+    ###############################################################################################
+    ### Saving & Loading
+    ###############################################################################################
+
+    def get_params(self):
+        return { "max_depth": self.max_depth, "min_samples_split": self.min_samples_split, "max_features": self.max_features,
+                 "max_bins": self.max_bins, "min_impurity_decrease": self.min_impurity_decrease, "max_leaf_nodes": self.max_leaf_nodes,
+                 "ccp_alpha": self.ccp_alpha, "random_state": self.random_state }
+
+    def get_arrays(self):
+        # Only the flattened representation is required for prediction (i.e., the Node objects are not saved)
+        return { "feature_idxs": self.feature_idxs, "thresholds": self.thresholds, "left_children": self.left_children,
+                 "right_children": self.right_children, "values": self.values }
+
+    def set_arrays(self, arrays):
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        arrays = self.get_arrays()
+        config = { "format_version": self.FORMAT_VERSION, "class": type(self).__name__, "params": self.get_params(), "arrays": list(arrays.keys()) }
+        with open(os.path.join(path, "model.json"), "w") as f:
+            json.dump(config, f)
+        for name, array in arrays.items():
+            # Object arrays (e.g., string labels) would require pickle, so they are converted to a native dtype first
+            if array.dtype == object:
+                array = np.array(array.tolist())
+            np.save(os.path.join(path, f"{name}.npy"), array)
+        return path
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        with open(os.path.join(path, "model.json")) as f:
+            config = json.load(f)
+        if config["format_version"] != cls.FORMAT_VERSION:
+            raise ValueError(f"Unsupported format version: {config['format_version']}")
+        if config["class"] != cls.__name__:
+            raise ValueError(f"The saved model is a {config['class']}, not a {cls.__name__}")
+        # Only the flattened tree is restored (all arrays are memory-mapped by default); the Node objects are not available
+        model = cls(**config["params"])
+        model.set_arrays({ name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in config["arrays"] })
+        return model
+
+
 
 class SeleneDecisionTreeClassifier(SeleneDecisionTree):
 
-    def __init__(self, max_depth: int=None, min_samples_split: int=2, max_features: int=None):
-        super().__init__(max_depth=max_depth, min_samples_split=min_samples_split, max_features=max_features)
+    def __init__(self, max_depth: int=None, min_samples_split: int=2, max_features: int=None, max_bins: int=None,
+                 min_impurity_decrease: float=0.0, max_leaf_nodes: int=None, ccp_alpha: float=0.0, random_state: int=None):
+        super().__init__(max_depth=max_depth, min_samples_split=min_samples_split, max_features=max_features, max_bins=max_bins,
+                         min_impurity_decrease=min_impurity_decrease, max_leaf_nodes=max_leaf_nodes, ccp_alpha=ccp_alpha, random_state=random_state)
+        self.classes = None
 
     
     def compute_gini_score_node(self, y):
@@ -202,22 +548,54 @@ class SeleneDecisionTreeClassifier(SeleneDecisionTree):
         return   len(y_left)/(len(y_left)+len(y_right))*gini_score_left \
                + len(y_right)/(len(y_left)+len(y_right))*gini_score_right
 
-    def fit(self, X, y):
-        return super().fit(X, y, self.compute_gini_score_node, self.compute_gini_score_split)
-
-    def predict(self, X):
-        # Get the targets for all samples
-        targets = self.get_targets(X)
+    def get_arrays(self):
+        # The class labels are needed to map the class counts to the predicted labels
+        arrays = super().get_arrays()
+        arrays["classes"] = self.classes
+        return arrays
+
+    def compute_node_value(self, y, weights=None):
+        # Summarize the node by its (weighted) class counts (w.r.t. all classes of the training data)
+        return np.bincount(np.searchsorted(self.classes, y), weights=weights, minlength=len(self.classes))
+
+    def compute_gini_stats(self, y):
+        # The statistics of a sample is its one-hot class vector (sums of those vectors are class counts)
+        _, codes = np.unique(y, return_inverse=True)
+        one_hot = np.zeros((len(y), codes.max()+1))
+        one_hot[np.arange(len(y)), codes] = 1
+        return one_hot
+
+    def compute_gini_scores_cumulative(self, stats):
+        # Compute the weighted Gini score of the splits stats[:i+1] / stats[i+1:] for all positions i at once
+        # (stats may have a leading axis, e.g., the histograms of several features, which are then handled separately)
+        counts_left = np.cumsum(stats, axis=-2)
+        counts_right = counts_left[...,-1:,:] - counts_left
+        n_left, n_right = np.sum(counts_left, axis=-1), np.sum(counts_right, axis=-1)
+        # Since len(y_left)*gini(y_left) = len(y_left) - sum(counts_left^2)/len(y_left) (same for the right child)
+        gini_left  = n_left - np.sum(np.square(counts_left), axis=-1) / np.maximum(n_left, 1)
+        gini_right = n_right - np.sum(np.square(counts_right), axis=-1) / np.maximum(n_right, 1)
+        return (gini_left + gini_right) / n_left[...,-1:]
+
+    def fit(self, X, y, sample_weight=None, bin_thresholds=None):
+        self.classes = np.unique(y)
+        return super().fit(X, y, self.compute_gini_score_node, self.compute_gini_score_split, self.compute_gini_stats, self.compute_gini_scores_cumulative,
+                           sample_weight, bin_thresholds)
+
+    def predict_batch(self, X):
+        # Get the class counts of the leaf of each sample
+        counts = self.values[self.get_leaf_ids(X)]
         # Return the majory class for each sample
-        return [ np.bincount(t).argmax() for t in targets ]
+        return self.classes[np.argmax(counts, axis=1)]
 
 
 
 
 class SeleneDecisionTreeRegressor(SeleneDecisionTree):
 
-    def __init__(self, max_depth: int=None, min_samples_split: int=2, max_features: int=None):
-        super().__init__(max_depth=max_depth, min_samples_split=min_samples_split, max_features=max_features)
+    def __init__(self, max_depth: int=None, min_samples_split: int=2, max_features: int=None, max_bins: int=None,
+                 min_impurity_decrease: float=0.0, max_leaf_nodes: int=None, ccp_alpha: float=0.0, random_state: int=None):
+        super().__init__(max_depth=max_depth, min_samples_split=min_samples_split, max_features=max_features, max_bins=max_bins,
+                         min_impurity_decrease=min_impurity_decrease, max_leaf_nodes=max_leaf_nodes, ccp_alpha=ccp_alpha, random_state=random_state)
 
     def compute_rss_score_node(self, y):
         # Compute the mean of both child nodes
@@ -238,11 +616,31 @@ class SeleneDecisionTreeRegressor(SeleneDecisionTree):
         return   len(y_left)/(len(y_left)+len(y_right))*rss_score_left \
                + len(y_right)/(len(y_left)+len(y_right))*rss_score_right
 
-    def fit(self, X, y):
-        return super().fit(X, y, self.compute_rss_score_node, self.compute_rss_score_split)
-
-    def predict(self, X):
-        # Get the targets for all samples
-        targets = self.get_targets(X)
-        # Return the majory class for each sample
-        return [ np.mean(t) for t in targets ]
+    def compute_node_value(self, y, weights=None):
+        # Summarize the node by the (weighted) mean of its targets
+        return np.average(y, weights=weights)
+
+    def compute_rss_stats(self, y):
+        # The statistics of a sample are (1, y, y^2) (sums of those are count, sum and sum of squares);
+        # centering the values first avoids cancellation errors in the sum of squares
+        y = y - np.mean(y)
+        return np.stack([np.ones(len(y)), y, np.square(y)], axis=1)
+
+    def compute_rss_scores_cumulative(self, stats):
+        # Compute the weighted RSS score of the splits stats[:i+1] / stats[i+1:] for all positions i at once
+        # (stats may have a leading axis, e.g., the histograms of several features, which are then handled separately)
+        cumulative = np.cumsum(stats, axis=-2)
+        n_left, sum_left, sumsq_left = cumulative[...,0], cumulative[...,1], cumulative[...,2]
+        n_right, sum_right, sumsq_right = n_left[...,-1:] - n_left, sum_left[...,-1:] - sum_left, sumsq_left[...,-1:] - sumsq_left
+        # Since len(y_left)*rss(y_left) = sum(y_left^2) - sum(y_left)^2/len(y_left) (same for the right child)
+        rss_left  = sumsq_left - np.square(sum_left) / np.maximum(n_left, 1)
+        rss_right = sumsq_right - np.square(sum_right) / np.maximum(n_right, 1)
+        return (rss_left + rss_right) / n_left[...,-1:]
+
+    def fit(self, X, y, sample_weight=None, bin_thresholds=None):
+        return super().fit(X, y, self.compute_rss_score_node, self.compute_rss_score_split, self.compute_rss_stats, self.compute_rss_scores_cumulative,
+                           sample_weight, bin_thresholds)
+
+    def predict_batch(self, X):
+        # Return the mean of the leaf of each sample
+        return self.values[self.get_leaf_ids(X)]
@@ -1,82 +1,275 @@
+import os
+import json
+import multiprocessing
 import numpy as np
-from sklearn.tree import DecisionTreeClassifier, DecisionTreeRegressor
+from itertools import chain
+from src.models.trees.dtree import SeleneDecisionTreeClassifier, SeleneDecisionTreeRegressor, predict_in_chunks
+
+
+
+def _fit_trees(args):
+    # Train one tree for each seed of a batch (executed by a worker process)
+    forest, X, y, DecisionTreeClass, bin_thresholds, seeds = args
+    return [ forest.fit_tree(X, y, DecisionTreeClass, seed, bin_thresholds) for seed in seeds ]
 
 
 
 
 class SeleneRandomForest():
 
-    def __init__(self, n_estimators: int=100, max_depth: int=None, min_samples_split: int=2, max_features: int=None):
+    FORMAT_VERSION = 1
+
+    def __init__(self, n_estimators: int=100, max_depth: int=None, min_samples_split: int=2, max_features: int=None, max_bins: int=None,
+                 min_impurity_decrease: float=0.0, max_leaf_nodes: int=None, ccp_alpha: float=0.0,
+                 compute_oob: bool=False, n_jobs: int=1, random_state: int=None):
         # Check if all arguments have meaningful values
         assert n_estimators is not None and n_estimators > 0, "The number of estimators must be greater than 0"
         assert max_depth is None or max_depth > 0, "The maximum depth must be greater than 0"
         assert min_samples_split is not None and min_samples_split > 1, "The minimum numbers of samples in a node must be greater than 1"
         assert max_features is None or max_features > 0, "The maximum number of features must be greater than 0"
+        assert max_bins is None or 2 <= max_bins <= 256, "The maximum number of bins must be between 2 and 256"
+        assert min_impurity_decrease >= 0, "The minimum impurity decrease must be greater or equal to 0"
+        assert max_leaf_nodes is None or max_leaf_nodes > 1, "The maximum number of leaves must be greater than 1"
+        assert ccp_alpha >= 0, "The complexity parameter must be greater or equal to 0"
+        assert n_jobs is not None and (n_jobs > 0 or n_jobs == -1), "The number of jobs must be greater than 0 (or -1 to use all CPUs)"
         #
         self.n_estimators = n_estimators
         self.max_depth = max_depth
         self.min_samples_split = min_samples_split
         self.max_features = max_features
+        self.max_bins = max_bins
+        self.min_impurity_decrease = min_impurity_decrease
+        self.max_leaf_nodes = max_leaf_nodes
+        self.ccp_alpha = ccp_alpha
+        self.compute_oob = compute_oob
+        self.n_jobs = n_jobs
+        self.random_state = random_state
         self.trees = []
+        self.seeds = None
+        # Out-of-bag (OOB) results: number of trees for which a sample was OOB, the OOB prediction, and the overall score
+        self.oob_counts, self.oob_predictions, self.oob_score = None, None, None
+
+    def get_n_jobs(self, n_tasks):
+        # Use all CPUs if n_jobs is -1, but never more processes than tasks
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        return max(1, min(n_jobs, n_tasks))
 
-    def create_bootstrap_sample(self, X, y):
+    def create_bootstrap_sample(self, X, y, rng=None):
         X_bootstrap, y_bootstrap = None, None
+        # Use NumPy's global random number generator if no specific one is given
+        if rng is None:
+            rng = np.random
         #
         N, d = X.shape
         #
-        random_sample_indices = np.random.choice(N, N, replace=True)
+        random_sample_indices = rng.choice(N, N, replace=True)
         #
         X_bootstrap = X[random_sample_indices]
         y_bootstrap = y[random_sample_indices]
         #
         return X_bootstrap, y_bootstrap
 
-    def sample_feature_indices(X, max_features: int=None):
-        # Get the number of available features
-        n_features = X.shape[1]
-        # Compute sample size as the minimum of available features and max_features value
-        if max_features is not None and max_features > 1:
-            n_features = min(n_features, max_features)
-        # Return a random sample of available indices of size n_features (without replacement)
-        return np.random.choice(np.arange(X.shape[1]), size=n_features, replace=False)
+    def create_bootstrap_weights(self, N, rng=None):
+        # Use NumPy's global random number generator if no specific one is given
+        if rng is None:
+            rng = np.random
+        # Same sampling as for create_bootstrap_sample(), but only count how often each sample has been drawn;
+        # training with these counts as sample weights is equivalent to training with the bootstrap sample
+        random_sample_indices = rng.choice(N, N, replace=True)
+        return np.bincount(random_sample_indices, minlength=N)
+
+    def get_oob_indices(self, N):
+        # Recreate the bootstrap weights of each tree from its seed; OOB samples are the ones with a weight of 0
+        return [ np.flatnonzero(self.create_bootstrap_weights(N, np.random.RandomState(seed)) == 0) for seed in self.seeds ]
+
+    def fit_tree(self, X, y, DecisionTreeClass, seed, bin_thresholds=None):
+        # All randomness of a tree (bootstrap sample and feature sampling at each split) only depends on its seed
+        # The bootstrap sample is represented by sample weights, so X and y are never copied
+        rng = np.random.RandomState(seed)
+        sample_weight = self.create_bootstrap_weights(len(y), rng)
+        tree = DecisionTreeClass(max_depth=self.max_depth, min_samples_split=self.min_samples_split, max_features=self.max_features,
+                                 max_bins=self.max_bins, min_impurity_decrease=self.min_impurity_decrease, max_leaf_nodes=self.max_leaf_nodes,
+                                 ccp_alpha=self.ccp_alpha, random_state=seed)
+        tree.fit(X, y, sample_weight=sample_weight, bin_thresholds=bin_thresholds)
+        # The forest only needs the flattened representation of the tree; dropping the Node objects also releases the
+        # index array of the tree and the reference to y (otherwise kept for each tree and copied back from each worker)
+        tree.tree = None
+        return tree
 
     def fit(self, X, y, DecisionTreeClass):
         self.trees = []
-    
-        for _ in range(self.n_estimators):
-            X_bootstrap, y_bootstrap = self.create_bootstrap_sample(X, y)
-            tree = DecisionTreeClass(max_depth=self.max_depth, min_samples_split=self.min_samples_split, max_features=self.max_features)
-            tree = tree.fit(X_bootstrap, y_bootstrap)
-            self.trees.append(tree)
+        # Prepare the data only once for all trees; in binned mode, all trees share the same quantized features
+        X, y, X_train, bin_thresholds = np.asarray(X), np.asarray(y), np.asarray(X), None
+        if self.max_bins is not None:
+            binning_tree = DecisionTreeClass(max_bins=self.max_bins)
+            X_train = binning_tree.bin_features(X)
+            bin_thresholds = binning_tree.bin_thresholds
+        # Draw the seeds of all trees upfront so the forest does not depend on the number of jobs
+        rng = np.random if self.random_state is None else np.random.RandomState(self.random_state)
+        self.seeds = rng.randint(0, 2**31-1, size=self.n_estimators)
+        # Train all trees, either directly or by distributing batches of seeds across worker processes
+        n_jobs = self.get_n_jobs(self.n_estimators)
+        if n_jobs == 1:
+            self.trees = [ self.fit_tree(X_train, y, DecisionTreeClass, seed, bin_thresholds) for seed in self.seeds ]
+        else:
+            batches = [ (self, X_train, y, DecisionTreeClass, bin_thresholds, batch) for batch in np.array_split(self.seeds, n_jobs) ]
+            with multiprocessing.Pool(n_jobs) as pool:
+                self.trees = list(chain.from_iterable(pool.map(_fit_trees, batches)))
+        # Evaluate each tree on the samples not in its bootstrap sample
+        if self.compute_oob:
+            self.compute_oob_predictions(X, y)
     
         return self
 
+    def predict(self, X, chunk_size: int=100_000):
+        return predict_in_chunks(self.predict_batch, X, chunk_size=chunk_size)
+
+    def get_tree_predictions(self, X):
+        # Pass X to all trees to get all predictions (one row per tree); this is always done in this process since
+        # prediction only uses the flattened trees and is vectorized over all samples (starting worker processes and
+        # sending them the trees for each chunk would cost much more than the prediction itself)
+        return np.asarray([ tree.predict(X) for tree in self.trees ])
+
+
+    def get_params(self):
+        return { "n_estimators": self.n_estimators, "max_depth": self.max_depth, "min_samples_split": self.min_samples_split,
+                 "max_features": self.max_features, "max_bins": self.max_bins, "min_impurity_decrease": self.min_impurity_decrease,
+                 "max_leaf_nodes": self.max_leaf_nodes, "ccp_alpha": self.ccp_alpha, "compute_oob": self.compute_oob,
+                 "n_jobs": self.n_jobs, "random_state": self.random_state }
+
+    def get_tree_arrays(self, tree):
+        # The flattened representation of a tree (see SeleneDecisionTree.get_arrays())
+        return tree.get_arrays()
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        # Concatenate the arrays of all trees into one array each; the nodes of tree i are at positions node_offsets[i]:node_offsets[i+1]
+        tree_arrays = [ self.get_tree_arrays(tree) for tree in self.trees ]
+        arrays = { name: np.concatenate([ a[name] for a in tree_arrays ]) for name in tree_arrays[0].keys() }
+        arrays["node_offsets"] = np.cumsum([0] + [ len(a["feature_idxs"]) for a in tree_arrays ])
+        arrays["seeds"] = self.seeds
+        config = { "format_version": self.FORMAT_VERSION, "class": type(self).__name__, "params": self.get_params(), "arrays": list(arrays.keys()) }
+        with open(os.path.join(path, "model.json"), "w") as f:
+            json.dump(config, f)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), array)
+        return path
+
+    @classmethod
+    def load(cls, path, DecisionTreeClass, mmap_mode="r"):
+        with open(os.path.join(path, "model.json")) as f:
+            config = json.load(f)
+        if config["format_version"] != cls.FORMAT_VERSION:
+            raise ValueError(f"Unsupported format version: {config['format_version']}")
+        if config["class"] != cls.__name__:
+            raise ValueError(f"The saved model is a {config['class']}, not a {cls.__name__}")
+        # All arrays are memory-mapped by default, and each tree only gets views of its part of the arrays
+        forest = cls(**config["params"])
+        arrays = { name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in config["arrays"] }
+        node_offsets, forest.seeds = arrays.pop("node_offsets"), arrays.pop("seeds")
+        forest.trees = []
+        for tree_idx, seed in enumerate(forest.seeds):
+            start, end = node_offsets[tree_idx], node_offsets[tree_idx+1]
+            tree = DecisionTreeClass(max_depth=forest.max_depth, min_samples_split=forest.min_samples_split, max_features=forest.max_features,
+                                     max_bins=forest.max_bins, min_impurity_decrease=forest.min_impurity_decrease,
+                                     max_leaf_nodes=forest.max_leaf_nodes, ccp_alpha=forest.ccp_alpha, random_state=seed)
+            tree.set_arrays({ name: array[start:end] for name, array in arrays.items() })
+            forest.trees.append(tree)
+        return forest
+
 
 class SeleneRandomForestClassifier(SeleneRandomForest):
 
-    def __init__(self, n_estimators: int=100, max_depth: int=None, min_samples_split: int=2, max_features: int=None):
-        super().__init__(n_estimators=n_estimators, max_depth=max_depth, min_samples_split=min_samples_split, max_features=max_features)
+    def __init__(self, n_estimators: int=100, max_depth: int=None, min_samples_split: int=2, max_features: int=None, max_bins: int=None,
+                 min_impurity_decrease: float=0.0, max_leaf_nodes: int=None, ccp_alpha: float=0.0,
+                 compute_oob: bool=False, n_jobs: int=1, random_state: int=None):
+        super().__init__(n_estimators=n_estimators, max_depth=max_depth, min_samples_split=min_samples_split, max_features=max_features, max_bins=max_bins,
+                         min_impurity_decrease=min_impurity_decrease, max_leaf_nodes=max_leaf_nodes, ccp_alpha=ccp_alpha,
+                         compute_oob=compute_oob, n_jobs=n_jobs, random_state=random_state)
+        self.classes = None
 
     def fit(self, X, y):
-        return super().fit(X, y, DecisionTreeClassifier)
+        self.classes = np.unique(y)
+        return super().fit(X, y, SeleneDecisionTreeClassifier)
+
+    def get_tree_arrays(self, tree):
+        # A tree only knows the classes of its bootstrap sample, so its class counts are mapped to the classes of the forest
+        arrays = tree.get_arrays()
+        values = np.zeros((len(arrays["values"]), len(self.classes)), dtype=arrays["values"].dtype)
+        values[:,np.searchsorted(self.classes, tree.classes)] = arrays["values"]
+        arrays["values"] = values
+        del arrays["classes"]
+        return arrays
 
-    def predict(self, X):
+    def save(self, path):
+        super().save(path)
+        # Object arrays (e.g., string labels) would require pickle, so they are converted to a native dtype first
+        np.save(os.path.join(path, "classes.npy"), np.array(self.classes.tolist()))
+        return path
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        forest = super().load(path, SeleneDecisionTreeClassifier, mmap_mode=mmap_mode)
+        # All trees share the classes of the forest
+        forest.classes = np.load(os.path.join(path, "classes.npy"))
+        for tree in forest.trees:
+            tree.classes = forest.classes
+        return forest
+
+    def compute_oob_predictions(self, X, y):
+        # Count the votes of all trees for which a sample was OOB
+        votes = np.zeros((len(y), len(self.classes)), dtype=np.int64)
+        for tree, oob_indices in zip(self.trees, self.get_oob_indices(len(y))):
+            votes[oob_indices, np.searchsorted(self.classes, tree.predict(X[oob_indices]))] += 1
+        self.oob_counts = np.sum(votes, axis=1)
+        self.oob_predictions = self.classes[np.argmax(votes, axis=1)]
+        # The OOB score is the accuracy over all samples with at least one OOB vote
+        has_oob = self.oob_counts > 0
+        self.oob_score = np.mean(self.oob_predictions[has_oob] == y[has_oob])
+
+    def predict_batch(self, X):
         # Pass X to all trees to get all predictions
-        ys = np.asarray([ tree.predict(X) for tree in self.trees ])
+        ys = self.get_tree_predictions(X)
+        # Count the votes for each class and sample at once (using the index of each class in the sorted list of all classes)
+        classes, codes = np.unique(ys, return_inverse=True)
+        codes = codes.reshape(ys.shape) + np.arange(ys.shape[1])*len(classes)
+        votes = np.bincount(codes.ravel(), minlength=ys.shape[1]*len(classes)).reshape(ys.shape[1], len(classes))
         # Compute the majority class label for each sample across all trees
-        return np.array([ np.bincount(ys[:, col]).argmax() for col in range(ys.shape[1]) ])
+        return classes[np.argmax(votes, axis=1)]
 
 
 class SeleneRandomForestRegressor(SeleneRandomForest):
 
-    def __init__(self, n_estimators: int=100, max_depth: int=None, min_samples_split: int=2, max_features: int=None):
-        super().__init__(n_estimators=n_estimators, max_depth=max_depth, min_samples_split=min_samples_split, max_features=max_features)
+    def __init__(self, n_estimators: int=100, max_depth: int=None, min_samples_split: int=2, max_features: int=None, max_bins: int=None,
+                 min_impurity_decrease: float=0.0, max_leaf_nodes: int=None, ccp_alpha: float=0.0,
+                 compute_oob: bool=False, n_jobs: int=1, random_state: int=None):
+        super().__init__(n_estimators=n_estimators, max_depth=max_depth, min_samples_split=min_samples_split, max_features=max_features, max_bins=max_bins,
+                         min_impurity_decrease=min_impurity_decrease, max_leaf_nodes=max_leaf_nodes, ccp_alpha=ccp_alpha,
+                         compute_oob=compute_oob, n_jobs=n_jobs, random_state=random_state)
 
     def fit(self, X, y):
-        return super().fit(X, y, DecisionTreeRegressor)
+        return super().fit(X, y, SeleneDecisionTreeRegressor)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        return super().load(path, SeleneDecisionTreeRegressor, mmap_mode=mmap_mode)
+
+    def compute_oob_predictions(self, X, y):
+        # Sum up the predictions of all trees for which a sample was OOB
+        sums, self.oob_counts = np.zeros(len(y)), np.zeros(len(y), dtype=np.int64)
+        for tree, oob_indices in zip(self.trees, self.get_oob_indices(len(y))):
+            sums[oob_indices] += tree.predict(X[oob_indices])
+            self.oob_counts[oob_indices] += 1
+        # The OOB prediction is the mean of all those predictions (NaN if a sample has never been OOB)
+        has_oob = self.oob_counts > 0
+        self.oob_predictions = np.full(len(y), np.nan)
+        self.oob_predictions[has_oob] = sums[has_oob] / self.oob_counts[has_oob]
+        # The OOB score is the R^2 score over all samples with at least one OOB prediction
+        residuals = y[has_oob] - self.oob_predictions[has_oob]
+        self.oob_score = 1 - np.sum(np.square(residuals)) / np.sum(np.square(y[has_oob] - np.mean(y[has_oob])))
 
-    def predict(self, X):
+    def predict_batch(self, X):
         # Pass X to all trees to get all predictions
-        ys = np.asarray([ tree.predict(X) for tree in self.trees ])
+        ys = self.get_tree_predictions(X)
         # Compute the mean for each sample across all trees
-        return np.mean(ys, axis=0)
\ No newline at end of file
+        return np.mean(ys, axis=0)
@@ -1,9 +1,25 @@
-import re, collections, regex
+import re, collections, regex, heapq, bisect
+from array import array
 from tqdm import tqdm
 
 
 
 
+def merge_token_pair(sequence, pair, new_id):
+    # Replace all occurrences of the token pair in the sequence of token ids (from left to right) by the id of the new token
+    merged_sequence, idx, n = array('i'), 0, len(sequence)
+    while idx < n:
+        if idx < n-1 and sequence[idx] == pair[0] and sequence[idx+1] == pair[1]:
+            merged_sequence.append(new_id)
+            idx += 2
+        else:
+            merged_sequence.append(sequence[idx])
+            idx += 1
+    return merged_sequence
+
+
+
+
 class MyWordTokenizer:
     
     def __init__(self):
@@ -70,31 +86,56 @@ class MyBpeTokenizer():
     PRE_TOKENIZE__SPLIT = 0
     PRE_TOKENIZE__GPT2  = 1
     
-    def __init__(self, eos='Ġ', pretokenize=PRE_TOKENIZE__SPLIT):
+    def __init__(self, eos='Ġ', pretokenize=PRE_TOKENIZE__SPLIT, cache_size=100_000):
         self._pretokenize = pretokenize
         self._eos = eos
         self._vocabulary = {}
-        self._corpus_state = {}
         self._merges = []
+        # The corpus state is stored as sequences of token ids (w.r.t. the symbol table) together with their frequencies
+        self._symbols, self._symbol_ids = [], {}
+        self._sequences, self._sequence_freqs = [], []
+        # For tokenizing: lookup of the ranks of each merge, and LRU cache of the tokens of recently tokenized words
+        self._merge_ranks = None
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+
+    @property
+    def _corpus_state(self):
+        # Convert the sequences of token ids into the readable representation (space-separated tokens -> frequency)
+        return { ' '.join([ self._symbols[tid] for tid in sequence ]): freq for sequence, freq in zip(self._sequences, self._sequence_freqs) }
+
+
+    def _get_symbol_id(self, token):
+        # Get the id of a token; unknown tokens are added to the symbol table
+        if token not in self._symbol_ids:
+            self._symbol_ids[token] = len(self._symbols)
+            self._symbols.append(token)
+        return self._symbol_ids[token]
 
 
     def _init(self, docs: list):
-        # Initialize vocabulary, corpus state, and list of merges
+        # Initialize vocabulary, word frequencies, and list of merges
         self._vocabulary = set()
-        self._corpus_state = collections.defaultdict(int)
+        word_counts = collections.Counter()
         self._merges = []
+        # Any previous merges are no longer valid for tokenizing
+        self._merge_ranks = None
+        self._cache.clear()
         # Loop over all documents
         for doc in docs:
             # Add all characters in the current document to the vocabulary
             self._vocabulary.update(set(doc))
-            # For each word in the document, generate the sequence and update add it to the corpus state
-            for word in self._pretokenize_text(doc):
-                self._corpus_state[self._generate_sequence(word)] += 1
+            # Count all words in the document
+            word_counts.update(self._pretokenize_text(doc))
         # Remove whitespace character from final vocabulary
         self._vocabulary.discard(" ")
         # Add EOS token
         self._vocabulary.add(self._eos)
-        self._corpus_state = dict(self._corpus_state)
+        # For each word, generate the sequence of token ids and add it to the corpus state
+        self._symbols, self._symbol_ids = [], {}
+        self._sequences = [ array('i', [ self._get_symbol_id(token) for token in self._generate_tokens(word) ]) for word in word_counts.keys() ]
+        self._sequence_freqs = list(word_counts.values())
 
     
     def _pretokenize_text(self, text):
@@ -107,38 +148,69 @@ class MyBpeTokenizer():
             raise Exception("Unknown pretokenization method.")
         
     
+    def _generate_tokens(self, word):
+        return [self._eos] + list(word)
+
+
     def _generate_sequence(self, word):
-        return ' '.join([self._eos] + (list(word)))
+        return ' '.join(self._generate_tokens(word))
+
+
+    def _init_pair_index(self):
+        # Count all token pairs and keep track of the sequences in which each token pair occurs (inverted index)
+        self._pair_counts = collections.defaultdict(int)
+        self._pair_index = collections.defaultdict(set)
+        for sid, (sequence, freq) in enumerate(zip(self._sequences, self._sequence_freqs)):
+            for pair in zip(sequence[:-1], sequence[1:]):
+                self._pair_counts[pair] += freq
+                self._pair_index[pair].add(sid)
+        # Max-heap of all token pairs w.r.t. their counts (heapq only supports min-heaps, hence the negative counts)
+        self._pair_heap = [ (-count, pair) for pair, count in self._pair_counts.items() ]
+        heapq.heapify(self._pair_heap)
 
 
     def _find_most_frequent_token_pair(self):
-        token_pair_counts = collections.defaultdict(int)
-        # Loop over corpus state to sum up occurrences of each existing token pair
-        for word, freq in self._corpus_state.items():
-            sequence = word.split()
-            for i in range(len(sequence)-1):
-                token_pair_counts[f"{sequence[i]} {sequence[i+1]}"] += freq
-        # Return the most frequent pair (if their are ties, we just randomly break them)
-        return max(token_pair_counts.keys(), key=(lambda key: token_pair_counts[key]))
+        # Pop token pairs until we find one whose count is up to date; outdated entries (i.e., the count of the pair has
+        # changed since the entry was pushed) are simply skipped since a more recent entry has been pushed as well
+        while len(self._pair_heap) > 0:
+            count, pair = heapq.heappop(self._pair_heap)
+            if self._pair_counts.get(pair) == -count:
+                # Return the most frequent pair (if their are ties, the pair with the smaller token ids wins)
+                return f"{self._symbols[pair[0]]} {self._symbols[pair[1]]}"
+        raise Exception("No more token pairs to merge.")
 
 
     def _perform_merge(self, token_pair):
+        first, second = token_pair.split(' ')
+        pair = (self._symbol_ids[first], self._symbol_ids[second])
         # Create new token by merging token pair
-        new_token = re.sub(' ', '', token_pair)
+        new_token = first + second
+        new_id = self._get_symbol_id(new_token)
         # Create merge as tuple of token pair and new token
         merge = (token_pair, new_token)
         # Add new token to vocabulary
         self._vocabulary.add(new_token)
-        # Define search pattern
-        pattern = re.compile(r"(?<!\S)" + re.escape(token_pair) + r"(?!\S)")
-        # Loop through corpus state and record which keys/sequences need to be updated
-        translate = {}
-        for sequence, count in self._corpus_state.items():
-            for match in pattern.finditer(sequence):
-                translate[sequence] = pattern.sub(new_token, sequence)
-        # Perform the update of keys/sequences
-        for old, new in translate.items():
-            self._corpus_state[new] = self._corpus_state.pop(old)
+        # Only update the sequences containing the token pair; for each sequence, the counts of all its old token pairs get
+        # decremented and the counts of all its new token pairs get incremented (by the frequency of the sequence)
+        updated_pairs = set()
+        for sid in self._pair_index.pop(pair, ()):
+            sequence, freq = self._sequences[sid], self._sequence_freqs[sid]
+            merged_sequence = merge_token_pair(sequence, pair, new_id)
+            for p in zip(sequence[:-1], sequence[1:]):
+                self._pair_counts[p] -= freq
+                updated_pairs.add(p)
+            for p in zip(merged_sequence[:-1], merged_sequence[1:]):
+                self._pair_counts[p] += freq
+                self._pair_index[p].add(sid)
+                updated_pairs.add(p)
+            self._sequences[sid] = merged_sequence
+        # Push the new counts of all updated token pairs; token pairs that no longer exist are removed
+        for p in updated_pairs:
+            if self._pair_counts[p] > 0:
+                heapq.heappush(self._pair_heap, (-self._pair_counts[p], p))
+            else:
+                del self._pair_counts[p]
+                self._pair_index.pop(p, None)
         return merge
         
     
@@ -147,6 +219,8 @@ class MyBpeTokenizer():
         if verbose == True:
             print("Initilize corpus and vocabulary...")
         self._init(docs)
+        # Count all token pairs once; each merge then only updates the counts of the affected sequences
+        self._init_pair_index()
         # Calculate the number of merging steps to be performed
         num_iter = max(0, (max_vocab_size-len(self._vocabulary)))
         # Perform the required number of merging steps; might stop sooner if not merge possible
@@ -162,6 +236,8 @@ class MyBpeTokenizer():
             merge = self._perform_merge(top_token_pair)
             # Add newly merged symbol to vocabulary
             self._merges.append(merge)
+        # The pair counts are no longer needed after training
+        self._pair_counts, self._pair_index, self._pair_heap = None, None, None
         return self
 
 
@@ -172,17 +248,53 @@ class MyBpeTokenizer():
         return tokens
 
     
+    def _get_merge_ranks(self):
+        # Map each merged token pair to its rank(s), i.e., the position(s) in the list of merges (only computed once)
+        if self._merge_ranks is None:
+            self._merge_ranks = collections.defaultdict(list)
+            for rank, (token_pair, _) in enumerate(self._merges):
+                self._merge_ranks[tuple(token_pair.split(' '))].append(rank)
+            self._merge_ranks = dict(self._merge_ranks)
+        return self._merge_ranks
+
+
     def _tokenize_word(self, word):
-        #
-        sequence = self._generate_sequence(word)
-        #
-        for p, m in self._merges:
-            if p not in sequence:
-                continue
-            pattern = re.compile(r'(?<!\S)' + re.escape(p) + r'(?!\S)')
-            sequence = pattern.sub(m, sequence)
-        #   
-        return sequence.split(' ')
+        # Return the cached tokens if the word has been tokenized recently
+        if word in self._cache:
+            self._cache.move_to_end(word)
+            return list(self._cache[word])
+        merge_ranks = self._get_merge_ranks()
+        tokens = self._generate_tokens(word)
+        # Instead of trying all merges in order, only consider the pairs in the word and always perform the merge
+        # with the lowest rank after the last performed merge (this yields the same tokens as performing all merges in order)
+        last_rank = -1
+        while len(tokens) > 1:
+            best_rank, best_pair = None, None
+            for pair in zip(tokens[:-1], tokens[1:]):
+                ranks = merge_ranks.get(pair)
+                if ranks is None:
+                    continue
+                idx = bisect.bisect_right(ranks, last_rank)
+                if idx < len(ranks) and (best_rank is None or ranks[idx] < best_rank):
+                    best_rank, best_pair = ranks[idx], pair
+            if best_pair is None:
+                break
+            # Merge all occurrences of the pair (from left to right)
+            merged_tokens, idx = [], 0
+            while idx < len(tokens):
+                if idx < len(tokens)-1 and tokens[idx] == best_pair[0] and tokens[idx+1] == best_pair[1]:
+                    merged_tokens.append(tokens[idx] + tokens[idx+1])
+                    idx += 2
+                else:
+                    merged_tokens.append(tokens[idx])
+                    idx += 1
+            tokens, last_rank = merged_tokens, best_rank
+        # Add the tokens to the cache; if the cache is full, remove the least recently used word
+        if self._cache_size > 0:
+            self._cache[word] = tuple(tokens)
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return tokens
 
 
     def detokenize(self, tokens: list):
@@ -200,27 +312,40 @@ class MyWordPieceTokenizer():
         self._pretokenize = pretokenize
         self._ctoken = ctoken
         self._vocabulary = {}
-        self._corpus_state = {}
         self._merges = []
+        # The corpus state is stored as sequences of token ids (w.r.t. the symbol table) together with their frequencies
+        self._symbols, self._symbol_ids = [], {}
+        self._sequences, self._sequence_freqs = [], []
+
+
+    @property
+    def _corpus_state(self):
+        # Convert the sequences of token ids into the readable representation (space-separated tokens -> frequency)
+        return { ' '.join([ self._symbols[tid] for tid in sequence ]): freq for sequence, freq in zip(self._sequences, self._sequence_freqs) }
+
+
+    def _get_symbol_id(self, token):
+        # Get the id of a token; unknown tokens are added to the symbol table
+        if token not in self._symbol_ids:
+            self._symbol_ids[token] = len(self._symbols)
+            self._symbols.append(token)
+        return self._symbol_ids[token]
 
     
     def _init(self, docs: list):
-        # Initialize vocabulary, corpus state, and list of merges
+        # Initialize vocabulary, word frequencies, and list of merges
         self._vocabulary = set()
-        self._corpus_state = collections.defaultdict(int)
+        word_counts = collections.Counter()
         self._merges = []
-        # Loop over all documents
+        # Loop over all documents and count all words
         for doc in docs:
-            # For each word in the document, generate the sequence and update add it to the corpus state
-            for word in self._pretokenize_text(doc):
-                # Update vocabulary
-                for idx, char in enumerate(word):
-                    if idx == 0:
-                        self._vocabulary.add(char)
-                    else:
-                        self._vocabulary.add(f"{self._ctoken}{char}")
-                # Update sequence count
-                self._corpus_state[self._generate_sequence(word)] += 1
+            word_counts.update(self._pretokenize_text(doc))
+        # For each word, generate the sequence of token ids and add it to the corpus state
+        self._symbols, self._symbol_ids = [], {}
+        self._sequences = [ array('i', [ self._get_symbol_id(token) for token in self._generate_tokens(word) ]) for word in word_counts.keys() ]
+        self._sequence_freqs = list(word_counts.values())
+        # Initial vocabulary: all first characters and all other characters (with continuation token) of all words
+        self._vocabulary.update(self._symbols)
 
     
     def _pretokenize_text(self, text):
@@ -232,57 +357,75 @@ class MyWordPieceTokenizer():
         else:
             raise Exception("Unknown pretokenization method.")
 
+
+    def _generate_tokens(self, word):
+        return [c if i == 0 else f"{self._ctoken}{c}" for i, c in enumerate(word)]
+
     
     def _generate_sequence(self, word):
-        return ' '.join([c if i == 0 else f"{self._ctoken}{c}" for i, c in enumerate(word)])
+        return ' '.join(self._generate_tokens(word))
+
+
+    def _init_pair_index(self):
+        # Count all tokens and token pairs, and keep track of the sequences in which each token pair occurs (inverted index)
+        self._token_counts = collections.defaultdict(int)
+        self._pair_counts = collections.defaultdict(int)
+        self._pair_index = collections.defaultdict(set)
+        for sid, (sequence, freq) in enumerate(zip(self._sequences, self._sequence_freqs)):
+            for tid in sequence:
+                self._token_counts[tid] += freq
+            for pair in zip(sequence[:-1], sequence[1:]):
+                self._pair_counts[pair] += freq
+                self._pair_index[pair].add(sid)
 
 
     def _find_best_token_pair(self):
-        token_counts = collections.defaultdict(int)
-        token_pair_counts = collections.defaultdict(int)
-        
-        for word, freq in self._corpus_state.items():
-            sequence = word.split()
-            if len(sequence) == 1:
-                token_counts[sequence[0]] += freq
-                continue
-            for i in range(len(sequence)-1):
-                pair = (sequence[i], sequence[i+1])
-                token_counts[f"{sequence[i]}"] += freq
-                token_pair_counts[pair] += freq
-            token_counts[sequence[-1]] += freq
-    
-        token_pair_scores = { 
-            ' '.join(pair): count / (token_counts[pair[0]] * token_counts[pair[1]]) 
-            for pair, count in token_pair_counts.items() 
-        }
-    
-        # Return the most frequent pair (if their are ties, we just randomly break them)
-        return max(token_pair_scores.keys(), key=(lambda key: token_pair_scores[key]))
+        # The score of a pair depends on the counts of both tokens, which change with each merge; so we compute
+        # the scores of all pairs each time but no longer need to recount the tokens and token pairs
+        token_counts = self._token_counts
+        best_pair = max(self._pair_counts.keys(), key=(lambda pair: self._pair_counts[pair] / (token_counts[pair[0]] * token_counts[pair[1]])))
+        # Return the pair with the highest score (if their are ties, we just randomly break them)
+        return f"{self._symbols[best_pair[0]]} {self._symbols[best_pair[1]]}"
 
 
     def _create_new_token(self, token_pair):
         t1, t2 = token_pair.split()
-        return ''.join([t1, re.sub(self._ctoken, "", t2)])
+        return ''.join([t1, t2.replace(self._ctoken, "")])
     
 
     def _perform_merge(self, token_pair):
+        first, second = token_pair.split(' ')
+        pair = (self._symbol_ids[first], self._symbol_ids[second])
         # Create new token by merging token pair
         new_token = self._create_new_token(token_pair)
+        new_id = self._get_symbol_id(new_token)
         # Create merge as tuple of token pair and new token
         merge = (token_pair, new_token)
         # Add new token to vocabulary
         self._vocabulary.add(new_token)
-        # Define search pattern
-        pattern = re.compile(r"(?<!\S)" + re.escape(token_pair) + r"(?!\S)")
-        # Loop through corpus state and record which keys/sequences need to be updated
-        matches = {}
-        for sequence, count in self._corpus_state.items():
-            for match in pattern.finditer(sequence):
-                matches[sequence] = pattern.sub(new_token, sequence)
-        # Perform the update of keys/sequences
-        for old, new in matches.items():
-            self._corpus_state[new] = self._corpus_state.pop(old)
+        # Only update the sequences containing the token pair; for each sequence, the counts of all its old tokens and
+        # token pairs get decremented and the counts of all its new ones get incremented (by the frequency of the sequence)
+        updated_pairs = set()
+        for sid in self._pair_index.pop(pair, ()):
+            sequence, freq = self._sequences[sid], self._sequence_freqs[sid]
+            merged_sequence = merge_token_pair(sequence, pair, new_id)
+            for tid in sequence:
+                self._token_counts[tid] -= freq
+            for tid in merged_sequence:
+                self._token_counts[tid] += freq
+            for p in zip(sequence[:-1], sequence[1:]):
+                self._pair_counts[p] -= freq
+                updated_pairs.add(p)
+            for p in zip(merged_sequence[:-1], merged_sequence[1:]):
+                self._pair_counts[p] += freq
+                self._pair_index[p].add(sid)
+                updated_pairs.add(p)
+            self._sequences[sid] = merged_sequence
+        # Remove all updated token pairs that no longer exist
+        for p in updated_pairs:
+            if self._pair_counts[p] <= 0:
+                del self._pair_counts[p]
+                self._pair_index.pop(p, None)
         # Return the merge
         return merge
 
@@ -292,6 +435,8 @@ class MyWordPieceTokenizer():
         if verbose == True:
             print("Initilize corpus and vocabulary...")
         self._init(docs)
+        # Count all tokens and token pairs once; each merge then only updates the counts of the affected sequences
+        self._init_pair_index()
         # Calculate the number of merging steps to be performed
         num_iter = max(0, (max_vocab_size-len(self._vocabulary)))
         # Perform the required number of merging steps; might stop sooner if not merge possible
@@ -307,6 +452,8 @@ class MyWordPieceTokenizer():
             merge = self._perform_merge(top_token_pair)
             # Add newly merged symbol to vocabulary
             self._merges.append(merge)
+        # The token and pair counts are no longer needed after training
+        self._token_counts, self._pair_counts, self._pair_index = None, None, None
         return self
 
 
@@ -0,0 +1,68 @@
+# Run from the notebooks/ directory: python -m pytest tests
+import numpy as np
+import pytest
+
+from src.models.ngram.ngramlm import CompactNGramLanguageModel, generate_bigram_data
+
+
+SENTENCES = ["the cat sat on the mat", "the dog sat on the log", "a cat saw the dog"] * 5
+TOKENS = ["the", "cat", "sat", "dog", "the", "unknown"]
+
+
+@pytest.mark.parametrize("smoothing", ["add-k", "kneser-ney", "stupid-backoff"])
+def test_bigram_data_of_quantized_model(smoothing):
+    model = CompactNGramLanguageModel(N=2, smoothing=smoothing)
+    model.train(SENTENCES)
+    df_bigrams, df_unigrams = generate_bigram_data(model, TOKENS, mode="probs")
+    model.quantize(bits=16)
+    df_bigrams_quantized, df_unigrams_quantized = generate_bigram_data(model, TOKENS, mode="probs")
+    # The context counts are unchanged, and the probabilities only differ by the quantization error
+    assert np.array_equal(df_unigrams.values, df_unigrams_quantized.values)
+    assert np.allclose(df_bigrams.values, df_bigrams_quantized.values, atol=1e-3)
+
+
+def test_bigram_counts_of_quantized_model():
+    model = CompactNGramLanguageModel(N=2)
+    model.train(SENTENCES)
+    model.quantize()
+    # The n-gram counts are dropped when quantizing the model
+    with pytest.raises(ValueError):
+        generate_bigram_data(model, TOKENS, mode="counts")
+
+
+@pytest.mark.parametrize("bits", [4, 32])
+def test_compress_rejects_unsupported_bits(bits):
+    model = CompactNGramLanguageModel(N=3, smoothing="kneser-ney")
+    model.train(SENTENCES)
+    nbytes = model.nbytes()
+    with pytest.raises(ValueError):
+        model.compress(nbytes // 2, bits=bits)
+    # The model is neither pruned nor quantized, so it can still be updated
+    assert model.nbytes() == nbytes
+    model.update(SENTENCES)
+
+
+def test_compress_rejects_quantized_model():
+    model = CompactNGramLanguageModel(N=2)
+    model.train(SENTENCES)
+    model.quantize()
+    with pytest.raises(ValueError):
+        model.compress(model.nbytes())
+
+
+@pytest.mark.parametrize("smoothing", ["add-k", "kneser-ney"])
+def test_save_overwrites_pruned_and_quantized_model(smoothing, tmp_path):
+    model = CompactNGramLanguageModel(N=3, smoothing=smoothing)
+    model.train(SENTENCES)
+    model.prune(min_count=2)
+    model.quantize()
+    model.save(tmp_path)
+    # Saving a model that is neither pruned nor quantized into the same directory leaves the optional arrays
+    # of the first model behind; they must not be loaded
+    model = CompactNGramLanguageModel(N=3, smoothing=smoothing)
+    model.train(SENTENCES)
+    model.save(tmp_path)
+    loaded = CompactNGramLanguageModel.load(tmp_path)
+    assert loaded.ngram_codes is None
+    assert all(store is None or store.context_pruned_counts is None for store in loaded.order_stores)
+    assert loaded.perplexity(SENTENCES) == pytest.approx(model.perplexity(SENTENCES))